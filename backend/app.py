@@ -1,69 +1,135 @@
 # backend/app.py
+# Production runs under gunicorn's gevent workers (see Procfile). The gevent
+# worker monkey-patches the stdlib before it imports this module, so pymongo,
+# requests and redis get cooperative sockets without patching here.
+import hashlib
 import os
-from flask import Flask, request, jsonify
+import secrets
+import uuid
+import orjson
+from flask import Flask, request
 from flask_cors import CORS
 from dotenv import load_dotenv
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.targets import FileTarget, ValueTarget
+from werkzeug.utils import secure_filename
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from googleapiclient.errors import HttpError
-
-
-from db import create_job, get_job, mark_job_done, serialize_job
+from backend.db import create_job, get_job, mark_job_done, serialize_job
+from backend.job_cache import cache_job, get_cached_job
+from backend.tasks import enqueue_job
+from video_uploader import authenticate
 
 load_dotenv()
 
 UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", "uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
 CORS(app)  #frontend (localhost:5500) will call the API
 
-YOUTUBE_INSTANCE = None
-
-SCOPES = ['https://www.googleapis.com/auth/youtube.upload']
-
-def authenticate():
-    global YOUTUBE_INSTANCE
-    """Authenticate and return YouTube API service"""
-    creds = None
-    # Get the directory where this script is located
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    token_path = os.path.join(script_dir, '../token.json')
-    secrets_path = os.path.join(script_dir, '../client_secrets.json')
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                secrets_path, SCOPES)
-            # Use a fixed port instead of port=0
-            creds = flow.run_local_server(port=8080)
-
-    # Token file stores the user's access and refresh tokens
-    if os.path.exists(token_path):
-        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
-
-    # If no valid credentials, let user log in
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                secrets_path, SCOPES)  # Use absolute path
-            creds = flow.run_local_server(port=0)
 
-        # Save credentials for next run
-        with open(token_path, 'w') as token:
-            token.write(creds.to_json())
+def ojson(payload, status=200):
+    """JSON response encoded with orjson (ObjectIds and other unknown types become strings)."""
+    body = orjson.dumps(payload, default=str, option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY)
+    return app.response_class(body, status=status, mimetype="application/json")
+
+
+class DigestFileTarget(FileTarget):
+    """
+    FileTarget that hashes the upload while writing it.
+
+    The file is created with O_EXCL (mode 0600), so an existing file or
+    symlink at that path is never written through; on a name clash a short
+    random suffix is appended to self.filename.
+    """
+
+    def __init__(self, filename, *args, **kwargs):
+        super().__init__(filename, *args, **kwargs)
+        self.digest = hashlib.blake2b(digest_size=32)
+
+    def on_start(self):
+        while True:
+            try:
+                fd = os.open(self.filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+                break
+            except FileExistsError:
+                self.filename = f"{self.filename}-{secrets.token_hex(4)}"
+        self._fd = os.fdopen(fd, "wb")
+
+    def on_data_received(self, chunk: bytes):
+        self.digest.update(chunk)
+        super().on_data_received(chunk)
+
+
+def read_job_form(save_document=True):
+    """
+    Read the 'text' field and the optional 'document' upload.
+
+    Multipart bodies are parsed straight off request.stream and the upload is
+    written to disk chunk by chunk. request.form / request.files are never
+    touched for them, as that would run Werkzeug's much slower form parser.
+
+    Uploads are stored by content as UPLOAD_FOLDER/<blake2b digest>, so the
+    same document uploaded twice is kept once. Nothing is stored when 'text'
+    is missing.
+
+    Returns:
+      (prompt_text, file_path, file_name, file_digest)
+
+    Raises:
+      ValueError: if 'text' is not valid UTF-8
+    """
+    if request.mimetype != "multipart/form-data":
+        return request.form.get("text"), None, None, None
+
+    parser = StreamingFormDataParser(headers=request.headers)
+    text_target = ValueTarget()
+    parser.register("text", text_target)
+
+    file_target = None
+    if save_document:
+        file_target = DigestFileTarget(os.path.join(UPLOAD_FOLDER, f".upload-{uuid.uuid4().hex}"))
+        parser.register("document", file_target)
 
-    youtube_instance = build('youtube', 'v3', credentials=creds)
-    YOUTUBE_INSTANCE = youtube_instance
+    try:
+        while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+            parser.data_received(chunk)
+        prompt_text = text_target.value.decode("utf-8") or None
+    except Exception as e:
+        if file_target is not None:
+            # the parser only closes the file when its part ends
+            if file_target._fd is not None:
+                file_target._fd.close()
+            if os.path.exists(file_target.filename):
+                os.remove(file_target.filename)
+        if isinstance(e, UnicodeDecodeError):
+            raise ValueError("'text' must be UTF-8 encoded")
+        raise
+
+    file_path = None
+    file_name = None
+    file_digest = None
+
+    if file_target is not None and os.path.exists(file_target.filename):
+        temp_path = file_target.filename
+        # browsers send an empty filename when no file was chosen
+        if prompt_text and file_target.multipart_filename:
+            # secure_filename() strips everything from e.g. all non-ASCII names
+            file_name = secure_filename(file_target.multipart_filename) or "upload.bin"
+            file_digest = file_target.digest.hexdigest()
+            file_path = os.path.join(UPLOAD_FOLDER, file_digest)
+            if os.path.exists(file_path):
+                # same content was uploaded before; keep the stored copy
+                os.remove(temp_path)
+            else:
+                os.replace(temp_path, file_path)
+        else:
+            os.remove(temp_path)
+
+    return prompt_text, file_path, file_name, file_digest
 
-    return youtube_instance
 
 @app.route("/api/agent_jobs", methods=["POST"])
 def create_job_route():
@@ -75,30 +141,23 @@ def create_job_route():
     Returns:
       { "job_id": "<id>" }
     """
-    prompt_text = request.form.get("text")
+    # agent jobs do not use the document, so it is not written to disk
+    try:
+        prompt_text, _, _, _ = read_job_form(save_document=False)
+    except ValueError as e:
+        return ojson({"error": str(e)}, 400)
     if not prompt_text:
-        return jsonify({"error": "Missing 'text' field"}), 400
-
-
-
-    file = request.files.get("document")
-    file_path = None
-    file_name = None
+        return ojson({"error": "Missing 'text' field"}, 400)
 
-    # if file and file.filename:
-    #     file_name = file.filename
-    #     filename = file.filename
-    #     file_path = os.path.join(UPLOAD_FOLDER, filename)
-    #     file.save(file_path)
     authenticate()
     job_id = create_job(prompt_text=prompt_text,
                         file_path=None,
                         file_name=None,
                         job_type="AGENT")
 
-    # TODO: enqueue background worker to process this job,
-    # generate video, and later call mark_job_done(...)
-    return jsonify({"job_id": job_id}), 200
+    # workers pick the job up from the broker; the request returns right away
+    enqueue_job(job_id, "AGENT")
+    return ojson({"job_id": job_id}, 200)
 
 
 @app.route("/api/jobs", methods=["POST"])
@@ -111,29 +170,22 @@ def create_job_route_new():
     Returns:
       { "job_id": "<id>" }
     """
-    prompt_text = request.form.get("text")
+    try:
+        prompt_text, file_path, file_name, file_digest = read_job_form()
+    except ValueError as e:
+        return ojson({"error": str(e)}, 400)
     if not prompt_text:
-        return jsonify({"error": "Missing 'text' field"}), 400
-
-
-
-    file = request.files.get("document")
-    file_path = None
-    file_name = None
+        return ojson({"error": "Missing 'text' field"}, 400)
 
-    # if file and file.filename:
-    #     file_name = file.filename
-    #     filename = file.filename
-    #     file_path = os.path.join(UPLOAD_FOLDER, filename)
-    #     file.save(file_path)
     # authenticate()
     job_id = create_job(prompt_text=prompt_text,
-                        file_path=None,
-                        file_name=None,)
+                        file_path=file_path,
+                        file_name=file_name,
+                        file_digest=file_digest,)
 
-    # TODO: enqueue background worker to process this job,
-    # generate video, and later call mark_job_done(...)
-    return jsonify({"job_id": job_id}), 200
+    # workers pick the job up from the broker; the request returns right away
+    enqueue_job(job_id)
+    return ojson({"job_id": job_id}, 200)
 
 
 @app.route("/api/jobs", methods=["GET"])
@@ -153,14 +205,19 @@ def get_job_status_route():
     """
     job_id = request.args.get("job_id")
     if not job_id:
-        return jsonify({"error": "Missing job_id"}), 400
-    try:
-        job_doc = get_job(job_id)
-    except ValueError:
-        return jsonify({"error": "Invalid job_id"}), 400
-    if not job_doc:
-        return jsonify({"error": "Job not found"}), 404
-    return jsonify(serialize_job(job_doc)), 200
+        return ojson({"error": "Missing job_id"}, 400)
+
+    # polling clients mostly hit the cache instead of MongoDB
+    body = get_cached_job(job_id)
+    if body is None:
+        try:
+            job_doc = get_job(job_id)
+        except ValueError:
+            return ojson({"error": "Invalid job_id"}, 400)
+        if not job_doc:
+            return ojson({"error": "Job not found"}, 404)
+        body = cache_job(job_id, serialize_job(job_doc))
+    return app.response_class(body, status=200, mimetype="application/json")
 
 
 # Optional: dummy route to simulate completion for testing
@@ -182,15 +239,18 @@ def complete_job_dummy_route(job_id):
     try:
         job_doc = mark_job_done(job_id, description, video_url)
     except ValueError:
-        return jsonify({"error": "Invalid job_id"}), 400
+        return ojson({"error": "Invalid job_id"}, 400)
 
     if not job_doc:
-        return jsonify({"error": "Job not found"}), 404
+        return ojson({"error": "Job not found"}, 404)
 
-    return jsonify(serialize_job(job_doc)), 200
+    return ojson(serialize_job(job_doc), 200)
 
 
 if __name__ == "__main__":
     # Backend runs on port 8000
     # Frontend HTML should use: const API_BASE = 'http://localhost:8000';
-    app.run(host="0.0.0.0", port=8000, debug=True)
+    if os.getenv("FLASK_ENV") in ("dev", "development"):
+        app.run(host="0.0.0.0", port=8000, debug=True)
+    else:
+        print("Run the backend with gunicorn (see Procfile), or set FLASK_ENV=development for the dev server")
@@ -1,24 +1,151 @@
 # backend/db.py
 import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
 from datetime import datetime, timezone, timedelta
-from datetime import datetime
 from typing import Optional, List, Dict
 
+import bson
 from bson import ObjectId
 from pymongo import MongoClient
 from dotenv import load_dotenv
 from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+
+from backend.job_cache import invalidate_job
 
 load_dotenv()
 
+# Every job read/write goes through BSON; the pure-Python fallback codec is
+# several times slower, so refuse to start without the C extension.
+if not bson.has_c():
+    raise ImportError("pymongo's bson C extension is missing; reinstall pymongo from a binary wheel")
+
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 MONGO_DB_NAME = "hack_nyu"
 
-client = MongoClient(MONGO_URI)
+# One pooled client per process, shared by every request and thread
+client = MongoClient(
+    MONGO_URI,
+    maxPoolSize=50,
+    minPoolSize=5,
+    waitQueueTimeoutMS=2000,
+    retryWrites=True,
+    appname="story-teller",
+)
 db = client[MONGO_DB_NAME]
 
 jobs_col = db["jobs"]
 agent_jobs_col = db["agent_jobs"]
+subheadings_col = db["subheadings"]
+
+SUBHEADING_VECTOR_INDEX = "sh_vec"
+
+COMPLETED_JOB_TTL_SECONDS = 30 * 24 * 3600
+
+# Agent jobs recur: after each run the job is due again this many seconds
+# later (0, the default, runs it again on the next worker tick)
+AGENT_JOB_INTERVAL_SECONDS = int(os.getenv("AGENT_JOB_INTERVAL_SECONDS", 0))
+
+
+def ensure_indexes():
+    """
+    Create the collection indexes. Run once at deploy time (python -m backend.db)
+    and at worker startup, so importing this module never waits on the server.
+    """
+    # Lets the pending-job claim (status + oldest created_at) be a single index seek
+    jobs_col.create_index([("status", 1), ("created_at", 1)])
+    # Same for agent jobs: pending, due by now, oldest first
+    agent_jobs_col.create_index([("status", 1), ("created_at", 1)])
+    # Purge finished jobs after 30 days so the working set stays in memory
+    jobs_col.create_index(
+        [("created_at", 1)],
+        name="completed_ttl",
+        expireAfterSeconds=COMPLETED_JOB_TTL_SECONDS,
+        partialFilterExpression={"status": "done"},
+    )
+
+
+INSERT_BATCH_SIZE = 200
+INSERT_BATCH_WAIT_SECONDS = 0.02
+
+
+class _InsertBatcher:
+    """
+    Coalesces concurrent inserts into a single insert_many round-trip.
+
+    A caller that finds no insert in flight writes directly with insert_one,
+    so low traffic pays no extra latency. Callers arriving while an insert is
+    in flight are queued and flushed together by a background thread, up to
+    INSERT_BATCH_SIZE docs or INSERT_BATCH_WAIT_SECONDS per batch.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self._direct_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+
+    def insert(self, doc: Dict) -> ObjectId:
+        """Insert doc and return its _id once it is written."""
+        if self._direct_lock.acquire(blocking=False):
+            try:
+                return self.collection.insert_one(doc).inserted_id
+            finally:
+                self._direct_lock.release()
+
+        self._start_flusher()
+        future = Future()
+        self._queue.put((doc, future))
+        return future.result()
+
+    def _start_flusher(self):
+        with self._flusher_lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_forever, daemon=True)
+                self._flusher.start()
+
+    def _next_batch(self) -> List:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + INSERT_BATCH_WAIT_SECONDS
+        while len(batch) < INSERT_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush_forever(self):
+        while True:
+            batch = self._next_batch()
+            docs = [doc for doc, _ in batch]
+            failed = {}
+            try:
+                self.collection.insert_many(docs, ordered=False, bypass_document_validation=True)
+            except BulkWriteError as e:
+                # unordered: every doc without a write error was inserted
+                for error in e.details.get("writeErrors", []):
+                    failed[error["index"]] = e
+            except Exception as e:
+                failed = {i: e for i in range(len(batch))}
+
+            # insert_many assigns _id on the docs before sending them
+            for i, (doc, future) in enumerate(batch):
+                if i in failed:
+                    future.set_exception(failed[i])
+                else:
+                    future.set_result(doc["_id"])
+
+
+_job_inserts = _InsertBatcher(jobs_col)
+_agent_job_inserts = _InsertBatcher(agent_jobs_col)
+
 
 def _to_object_id(job_id: str) -> ObjectId:
     """Convert string job_id to ObjectId, or raise ValueError."""
@@ -27,7 +154,8 @@ def _to_object_id(job_id: str) -> ObjectId:
     except Exception:
         raise ValueError("Invalid job_id")
 
-def create_job(prompt_text: str, file_path: Optional[str], file_name: Optional[str], job_type="NORMAL") -> str:
+def create_job(prompt_text: str, file_path: Optional[str], file_name: Optional[str], job_type="NORMAL",
+               file_digest: Optional[str] = None) -> str:
     """Insert a new job into MongoDB and return its string job_id."""
 
     if job_type == "NORMAL":
@@ -35,6 +163,7 @@ def create_job(prompt_text: str, file_path: Optional[str], file_name: Optional[s
             "prompt_text": prompt_text,
             "file_path": file_path,
             "file_name": file_name,
+            "file_digest": file_digest,
             "status": "pending",
             "description": None,
             "video_url": None,
@@ -43,8 +172,7 @@ def create_job(prompt_text: str, file_path: Optional[str], file_name: Optional[s
             "next_upload": datetime.utcnow(),
         }
 
-        result = jobs_col.insert_one(job_doc)
-        return str(result.inserted_id)
+        return str(_job_inserts.insert(job_doc))
     else:
         job_doc = {
             "prompt_text": prompt_text,
@@ -56,12 +184,15 @@ def create_job(prompt_text: str, file_path: Optional[str], file_name: Optional[s
             "next_upload": datetime.utcnow(),
         }
 
-        result = agent_jobs_col.insert_one(job_doc)
-        return str(result.inserted_id)
+        return str(_agent_job_inserts.insert(job_doc))
+
+# Fields read by serialize_job (_id is always returned)
+JOB_STATUS_PROJECTION = {"status": 1, "description": 1, "video_url": 1, "error": 1}
+
 
 def get_job(job_id: str) -> Optional[Dict]:
     oid = _to_object_id(job_id)
-    return jobs_col.find_one({"_id": oid})
+    return jobs_col.find_one({"_id": oid}, projection=JOB_STATUS_PROJECTION)
 
 def get_all_new_jobs():
     return jobs_col.find_one({"status": "pending"})
@@ -69,7 +200,7 @@ def get_all_new_jobs():
 
 def mark_job_done(job_id: str, description: str, video_url: str) -> Optional[Dict]:
     oid = _to_object_id(job_id)
-    result = jobs_col.update_one(
+    job_doc = jobs_col.find_one_and_update(
         {"_id": oid},
         {
             "$set": {
@@ -79,10 +210,11 @@ def mark_job_done(job_id: str, description: str, video_url: str) -> Optional[Dic
                 "error": None,
             }
         },
+        projection=JOB_STATUS_PROJECTION,
+        return_document=ReturnDocument.AFTER,
     )
-    if result.matched_count == 0:
-        return None
-    return jobs_col.find_one({"_id": oid})
+    invalidate_job(job_id)
+    return job_doc
 
 def serialize_job(job_doc: Dict) -> Optional[Dict]:
     if not job_doc:
@@ -99,56 +231,112 @@ def serialize_job(job_doc: Dict) -> Optional[Dict]:
 def get_next_pending_job(job_type = "NORMAL") -> dict | None:
     """
     Atomically find ONE pending job, mark it as 'running', and return it.
+    Claimed jobs get a started_at timestamp.
     Returns the job document or None if nothing is pending.
     """
     if job_type == "NORMAL":
         job_doc = jobs_col.find_one_and_update(
             {"status": "pending"},
-            {"$set": {"status": "running"}},
+            {"$set": {"status": "running", "started_at": datetime.utcnow()}},
             sort=[("created_at", 1)],  # oldest first
             return_document=ReturnDocument.AFTER,
         )
         return job_doc
     else:
-        print("fidingg agent jobs")
-        job_doc = agent_jobs_col.find_one(
-            {},
-            sort=[("created_at", 1)],
+        # agent jobs can be scheduled ahead: only those due by now are picked
+        return agent_jobs_col.find_one_and_update(
+            {"status": "pending", "created_at": {"$lte": datetime.utcnow()}},
+            {"$set": {"status": "running", "started_at": datetime.utcnow()}},
+            sort=[("created_at", 1)],  # oldest first
+            return_document=ReturnDocument.AFTER,
         )
-        print("found job")
 
-        if job_doc is not None:
-            dt = job_doc["created_at"]
 
-            if dt.tzinfo is None:
-                dt = dt.replace(tzinfo=timezone.utc)
+def reschedule_agent_job(job_id: str, video_url: Optional[str]) -> Optional[Dict]:
+    """
+    Put an agent job back to 'pending' after a run, due again in
+    AGENT_JOB_INTERVAL_SECONDS; every run makes a video on a new subheading.
+    Returns updated document (status fields only) or None if not found.
+    """
+    oid = _to_object_id(job_id)
+    next_run = datetime.utcnow() + timedelta(seconds=AGENT_JOB_INTERVAL_SECONDS)
+    return agent_jobs_col.find_one_and_update(
+        {"_id": oid},
+        {
+            "$set": {
+                "status": "pending",
+                "video_url": video_url,
+                "error": None,
+                "created_at": next_run,
+                "next_upload": next_run,
+            }
+        },
+        projection=JOB_STATUS_PROJECTION,
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def mark_agent_job_failed(job_id: str, error: str) -> Optional[Dict]:
+    """
+    Mark an agent job whose run raised as 'error', so it is not picked again.
+    Returns updated document (status fields only) or None if not found.
+    """
+    oid = _to_object_id(job_id)
+    return agent_jobs_col.find_one_and_update(
+        {"_id": oid},
+        {"$set": {"status": "error", "error": error}},
+        projection=JOB_STATUS_PROJECTION,
+        return_document=ReturnDocument.AFTER,
+    )
 
-            now = datetime.now(timezone.utc)
-            is_past = dt < now
 
-            if is_past:
-                #  lets not upadate it now
+def stream_pending_jobs():
+    """
+    Yield pending jobs as they are inserted, claiming each one as 'running'.
 
-                # new_created_at = datetime.now(timezone.utc) + timedelta(days=2)
-                #
-                # # Update this job only
-                # agent_jobs_col.update_one(
-                #     {"_id": job_doc["_id"]},
-                #     {"$set": {"created_at": new_created_at}}
-                # )
+    Uses a change stream, so the caller blocks inside the driver until MongoDB
+    pushes a new job instead of polling. Jobs that were already pending when
+    the stream opened are claimed first. The conditional claim keeps each job
+    with a single worker even when many workers watch the same collection.
+    Change streams need a replica set; on a standalone server watch() raises
+    OperationFailure.
+    """
+    pipeline = [{"$match": {"operationType": "insert"}}]
+    with jobs_col.watch(pipeline) as stream:
+        # drain the backlog only after the stream is open so no insert is missed
+        while (job_doc := get_next_pending_job()) is not None:
+            yield job_doc
 
-                return job_doc
+        for change in stream:
+            job_doc = jobs_col.find_one_and_update(
+                {"_id": change["documentKey"]["_id"], "status": "pending"},
+                {"$set": {"status": "running", "started_at": datetime.utcnow()}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if job_doc is not None:
+                yield job_doc
 
-            return None
-        return None
+
+def claim_job(job_id: str, job_type="NORMAL") -> Optional[Dict]:
+    """
+    Atomically mark the given job as 'running' if it is still pending.
+    Returns the job document, or None if it was already claimed or not found.
+    """
+    oid = _to_object_id(job_id)
+    col = jobs_col if job_type == "NORMAL" else agent_jobs_col
+    return col.find_one_and_update(
+        {"_id": oid, "status": "pending"},
+        {"$set": {"status": "running", "started_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER,
+    )
 
 
 def update_job_result(job_id: str, description: Optional[str], video_url: Optional[str], subheadings: List[Dict]) -> Optional[dict]:
     """
-    Returns updated document or None if not found.
+    Returns updated document (status fields only) or None if not found.
     """
     oid = _to_object_id(job_id)
-    result = jobs_col.update_one(
+    job_doc = jobs_col.find_one_and_update(
         {"_id": oid},
         {
             "$set": {
@@ -159,7 +347,60 @@ def update_job_result(job_id: str, description: Optional[str], video_url: Option
                 "error": None,
             }
         },
+        projection=JOB_STATUS_PROJECTION,
+        return_document=ReturnDocument.AFTER,
     )
-    if result.matched_count == 0:
-        return None
-    return jobs_col.find_one({"_id": oid})
+    invalidate_job(job_id)
+    return job_doc
+
+
+def find_most_similar_subheading(embedding: List[float]) -> Optional[Dict]:
+    """
+    Find the stored subheading closest to the embedding with Atlas Vector Search.
+
+    Needs an Atlas vector search index named SUBHEADING_VECTOR_INDEX on
+    subheadings.embedding, e.g.
+      {"fields": [{"type": "vector", "path": "embedding",
+                   "numDimensions": 384, "similarity": "cosine"}]}
+
+    Returns:
+      {"text": "...", "similarity": <cosine>} or None if nothing is stored
+    """
+    results = subheadings_col.aggregate([
+        {
+            "$vectorSearch": {
+                "index": SUBHEADING_VECTOR_INDEX,
+                "path": "embedding",
+                "queryVector": embedding,
+                "numCandidates": 50,
+                "limit": 1,
+            }
+        },
+        {"$project": {"_id": 0, "text": 1, "score": {"$meta": "vectorSearchScore"}}},
+    ])
+    for doc in results:
+        # Atlas reports cosine matches as (1 + cosine) / 2
+        return {"text": doc["text"], "similarity": 2 * doc["score"] - 1}
+    return None
+
+
+def add_subheading(text: str, embedding: List[float]):
+    subheadings_col.insert_one({
+        "text": text,
+        "embedding": embedding,
+        "created_at": datetime.utcnow(),
+    })
+
+
+def get_subheadings() -> List[str]:
+    cursor = subheadings_col.find({}, {"_id": 0, "text": 1}).sort("created_at", 1)
+    return [doc["text"] for doc in cursor]
+
+
+def clear_subheadings():
+    subheadings_col.delete_many({})
+
+
+if __name__ == "__main__":
+    ensure_indexes()
+    print("Indexes created")
@@ -3,12 +3,19 @@ Generate unique subheadings from a base prompt using OpenRouter API
 This module uses GPT-OSS-20B model to generate subheadings and ensures
 they are semantically unique using the SemanticSimilarityChecker.
 """
+import asyncio
+import contextlib
+import functools
 import os
+import threading
 
-import requests
+import httpx
 import json
+import orjson
+from backend import db
 from backend.similarity_checker_cosine import SemanticSimilarityChecker
 from dotenv import load_dotenv
+from llm_cache import CACHE_DIR
 
 load_dotenv()
 
@@ -20,83 +27,161 @@ OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
 MODEL_NAME = "openai/gpt-5.1"
 # "google/gemini-flash-1.5-8b"
 # "openai/gpt-oss-20b:free"
+TEMPERATURE = 0.8  # Higher temperature for more variety
+# Identical requests sent concurrently per round by generate_prompt_subheading
+SPECULATIVE_REQUESTS = 3
+
+API_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+    # completions (reasoning_details especially) compress well
+    "Accept-Encoding": "gzip, br",
+    # "HTTP-Referer": "https://github.com/your-repo",  # Optional
+    # "X-Title": "Subheading Generator"  # Optional
+}
+
+# Retries for throttled / unavailable responses, with exponential backoff
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.3
+RETRY_STATUSES = {429, 502, 503, 504}
+
+# One HTTP/2 client for all calls, living on a background event loop so its
+# keep-alive TLS connection is reused from one generate_prompt_subheading call
+# to the next. Connection failures are retried by the transport.
+# Pool limits go on the transport: the client ignores its own limits (and
+# http2) once a transport is given.
+_client = None
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _event_loop():
+    """Return the background event loop shared by all calls, starting it on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="openrouter", daemon=True).start()
+        return _loop
+
+
+def _shared_client():
+    """Return the shared httpx.AsyncClient; only use it on _event_loop()."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            headers=API_HEADERS,
+            timeout=30,
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=MAX_RETRIES,
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            ),
+        )
+    return _client
+
+
+# Where generated subheadings are kept for the uniqueness check:
+#   "memory" - in the similarity checker of this process, saved to
+#              SUBHEADING_STORE_PATH so restarts keep the history
+#   "mongo"  - in MongoDB, shared by all workers (needs Atlas Vector Search)
+SUBHEADING_STORE = os.getenv("SUBHEADING_STORE", "memory")
+# Only for the "memory" store. Each process keeps its own store, so with several
+# worker processes the last one to add a subheading wins; use "mongo" there.
+SUBHEADING_STORE_PATH = os.getenv("SUBHEADING_STORE_PATH", os.path.join(CACHE_DIR, "subheadings.npz"))
+if SUBHEADING_STORE != "mongo":
+    os.makedirs(os.path.dirname(SUBHEADING_STORE_PATH) or ".", exist_ok=True)
 
 # Initialize the similarity checker globally (persists across function calls)
-similarity_checker = SemanticSimilarityChecker(threshold=0.75)
+similarity_checker = SemanticSimilarityChecker(
+    threshold=0.75,
+    quantize=os.getenv("QUANTIZE_SUBHEADINGS", "0") == "1",
+    precision=os.getenv("SUBHEADING_MODEL_PRECISION", "fp32"),
+    device=os.getenv("SUBHEADING_MODEL_DEVICE", "auto"),
+    store_path=SUBHEADING_STORE_PATH if SUBHEADING_STORE != "mongo" else None,
+)
+
+
+# Fixed part of every request body; only messages and max_tokens vary per call
+_PAYLOAD_TEMPLATE = {
+    "model": MODEL_NAME,
+    "temperature": TEMPERATURE,
+}
+
 
+def _build_payload(prompt, max_tokens):
+    """Return the JSON-encoded request body for a single user prompt."""
+    # merged into a new dict, so concurrent callers never share mutable state
+    return orjson.dumps({
+        **_PAYLOAD_TEMPLATE,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": max_tokens,
+    })
+
+
+def _extract_generated_text(data):
+    """
+    Pull the generated text out of a chat completion response.
 
-def call_openrouter_api(prompt, max_tokens=400):
+    Returns:
+        str: Generated text, or None if the response has no usable content
     """
-    Call OpenRouter API to generate text using GPT-OSS-20B model.
+    # Check if we have the expected structure
+    if 'choices' not in data or len(data['choices']) == 0:
+        print(f"Unexpected API response structure: {json.dumps(data, indent=2)}")
+        return None
     
+    message = data['choices'][0]['message']
+    
+    # For reasoning models, the content might be in 'content' or 'reasoning'
+    generated_text = message.get('content', '').strip()
+    print(">>>> Generated text:", generated_text)
+    
+    # If content is empty, try to get the last reasoning detail
+    if not generated_text and 'reasoning_details' in message:
+        reasoning_details = message['reasoning_details']
+        if reasoning_details:
+            # Get the last reasoning entry which should contain the answer
+            generated_text = reasoning_details[-1].get('text', '').strip()
+    
+    # If still empty, try the reasoning field directly
+    if not generated_text and 'reasoning' in message:
+        generated_text = message['reasoning'].strip()
+    
+    if not generated_text:
+        print(f"⚠️ API returned empty content. Full response: {json.dumps(data, indent=2)}")
+        return None
+        
+    return generated_text
+
+
+async def _request_completion_async(client, prompt, max_tokens=400):
+    """
+    Send one chat completion request to OpenRouter. Throttled / unavailable
+    responses (RETRY_STATUSES) are retried with exponential backoff.
+
     Args:
+        client (httpx.AsyncClient): Client to send the request with
         prompt (str): The prompt to send to the model
         max_tokens (int): Maximum tokens in the response
-        
+
     Returns:
         str: Generated text from the model, or None if error occurs
     """
-    print("Calling prmopt", prompt)
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        # "HTTP-Referer": "https://github.com/your-repo",  # Optional
-        # "X-Title": "Subheading Generator"  # Optional
-    }
-    
-    payload = {
-        "model": MODEL_NAME,
-        "messages": [
-            {
-                "role": "user",
-                "content": prompt
-            }
-        ],
-        "max_tokens": max_tokens,
-        "temperature": 0.8  # Higher temperature for more variety
-    }
-    
+    payload = _build_payload(prompt, max_tokens)
+    data = None
     try:
-        print(f"Calling API with model: {MODEL_NAME}")
-        response = requests.post(OPENROUTER_API_URL, headers=headers, json=payload, timeout=30)
+        for attempt in range(MAX_RETRIES + 1):
+            response = await client.post(OPENROUTER_API_URL, content=payload)
+            if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                break
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
         response.raise_for_status()
-        
-        data = response.json()
-        
-        # Debug: Print the full response
-        print(f"API Response Status: {response.status_code}")
-        
-        # Check if we have the expected structure
-        if 'choices' not in data or len(data['choices']) == 0:
-            print(f"Unexpected API response structure: {json.dumps(data, indent=2)}")
-            return None
-        
-        message = data['choices'][0]['message']
-        
-        # For reasoning models, the content might be in 'content' or 'reasoning'
-        generated_text = message.get('content', '').strip()
-        print(">>>> Generated text:", generated_text)
-        
-        # If content is empty, try to get the last reasoning detail
-        if not generated_text and 'reasoning_details' in message:
-            reasoning_details = message['reasoning_details']
-            if reasoning_details:
-                # Get the last reasoning entry which should contain the answer
-                generated_text = reasoning_details[-1].get('text', '').strip()
-        
-        # If still empty, try the reasoning field directly
-        if not generated_text and 'reasoning' in message:
-            generated_text = message['reasoning'].strip()
-        
-        if not generated_text:
-            print(f"⚠️ API returned empty content. Full response: {json.dumps(data, indent=2)}")
-            return None
-            
-        return generated_text
-    
-    except requests.exceptions.RequestException as e:
+        data = orjson.loads(response.content)
+        return _extract_generated_text(data)
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
         print(f"API Error: {e}")
-        if hasattr(e, 'response') and e.response is not None:
+        if isinstance(e, httpx.HTTPStatusError):
             print(f"Response Status: {e.response.status_code}")
             print(f"Response: {e.response.text}")
         return None
@@ -106,6 +191,73 @@ def call_openrouter_api(prompt, max_tokens=400):
         return None
 
 
+def _clean_subheading(generated_text):
+    """
+    Normalize a generated subheading, truncated to 10 words.
+
+    Returns:
+        str: The subheading, or None if there is nothing usable
+    """
+    if generated_text is None:
+        print("⚠️  API call failed, retrying...")
+        return None
+    
+    # Clean up the generated text
+    subheading = generated_text.strip().strip('"').strip("'")
+    
+    # Check if we got an empty response
+    if not subheading:
+        print(f"⚠️ Received empty subheading from API, retrying...")
+        return None
+    
+    # Check word count
+    word_count = len(subheading.split())
+    if word_count > 10:
+        print(f"⚠️  Generated subheading too long ({word_count} words): '{subheading}'")
+        print("    Truncating to 10 words...")
+        subheading = ' '.join(subheading.split()[:10])
+    
+    print(f"📝 Generated: '{subheading}' ({len(subheading.split())} words)")
+    return subheading
+
+
+# These helpers block (model inference, MongoDB round trips), so the async
+# code runs them in threads; the in-memory store is not safe to read while
+# another thread adds to it.
+_memory_store_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=256)
+def _embed_subheading(subheading):
+    return similarity_checker.get_embeddings(subheading)[0].tolist()
+
+
+def _is_similar_to_stored(subheading):
+    """
+    Check a subheading against the configured store.
+
+    Returns:
+        tuple: (is_similar, max_similarity_score, most_similar_subheading)
+    """
+    if SUBHEADING_STORE != "mongo":
+        with _memory_store_lock:
+            return similarity_checker.is_similar_to_any_stored(subheading)
+
+    match = db.find_most_similar_subheading(_embed_subheading(subheading))
+    if match is None:
+        return False, 0.0, None
+    is_similar = match["similarity"] >= similarity_checker.threshold
+    return is_similar, match["similarity"], match["text"]
+
+
+def _store_subheading(subheading):
+    if SUBHEADING_STORE != "mongo":
+        with _memory_store_lock:
+            similarity_checker.add_subheading(subheading)
+    else:
+        db.add_subheading(subheading, _embed_subheading(subheading))
+
+
 def generate_prompt_subheading(base_prompt, max_attempts=10):
     """
     Generate a unique subheading from a base prompt.
@@ -119,6 +271,33 @@ def generate_prompt_subheading(base_prompt, max_attempts=10):
         base_prompt (str): The base topic (e.g., "Machine Learning")
         max_attempts (int): Maximum number of attempts to generate a unique subheading
         
+    Returns:
+        str: A unique subheading (max 10 words), or None if failed after max_attempts
+    """
+    async def run():
+        return await generate_prompt_subheading_async(base_prompt, max_attempts, client=_shared_client())
+
+    return asyncio.run_coroutine_threadsafe(run(), _event_loop()).result()
+
+
+async def generate_prompt_subheading_async(base_prompt, max_attempts=10,
+                                           speculative_requests=SPECULATIVE_REQUESTS, client=None):
+    """
+    Async version of generate_prompt_subheading.
+
+    Attempts run in rounds of `speculative_requests` concurrent requests with
+    the same prompt (the sampling temperature makes them differ). The first
+    answer that passes the similarity check wins and the rest of the round is
+    cancelled; rejected answers are added to the "Avoid topics" list for the
+    next round.
+    
+    Args:
+        base_prompt (str): The base topic (e.g., "Machine Learning")
+        max_attempts (int): Maximum number of requests in total
+        speculative_requests (int): Concurrent requests per round
+        client (httpx.AsyncClient): Client bound to the running event loop; a
+                                    temporary one is opened if not given
+        
     Returns:
         str: A unique subheading (max 10 words), or None if failed after max_attempts
     """
@@ -131,47 +310,47 @@ def generate_prompt_subheading(base_prompt, max_attempts=10):
     # """STRICTLY Output only the topic. Do NOT use special character. DO NOT write anything other than the topic.
     # Example: input 'write about Machine Learning', output 'create a video regarding Unsupervised Learning'."""
     
-    for attempt in range(1, max_attempts + 1):
-        print(f"\n🔄 Attempt {attempt}/{max_attempts}...")
-        
-        # Generate subheading using OpenRouter API
-        generated_text = call_openrouter_api(api_prompt)
-        
-        if generated_text is None:
-            print("⚠️  API call failed, retrying...")
-            continue
-        
-        # Clean up the generated text
-        subheading = generated_text.strip().strip('"').strip("'")
-        
-        # Check if we got an empty response
-        if not subheading:
-            print(f"⚠️ Received empty subheading from API, retrying...")
-            continue
-        
-        # Check word count
-        word_count = len(subheading.split())
-        if word_count > 10:
-            print(f"⚠️  Generated subheading too long ({word_count} words): '{subheading}'")
-            print("    Truncating to 10 words...")
-            subheading = ' '.join(subheading.split()[:10])
-        
-        print(f"📝 Generated: '{subheading}' ({len(subheading.split())} words)")
-        
-        # Check if similar to any stored subheading
-        is_similar, score, similar_to = similarity_checker.is_similar_to_any_stored(subheading)
-        
-        if is_similar:
-            print(f"❌ REJECTED - Too similar to: '{similar_to}'")
-            print(f"   Similarity score: {score:.3f}")
+    attempts = 0
+    async with contextlib.AsyncExitStack() as stack:
+        if client is None:
+            client = await stack.enter_async_context(httpx.AsyncClient(http2=True, headers=API_HEADERS, timeout=30))
+        while attempts < max_attempts:
+            round_size = min(speculative_requests, max_attempts - attempts)
+            print(f"\n🔄 Attempts {attempts + 1}-{attempts + round_size}/{max_attempts}...")
+            attempts += round_size
+            avoid = []
+
+            async with asyncio.TaskGroup() as tg:
+                tasks = [tg.create_task(_request_completion_async(client, api_prompt))
+                         for _ in range(round_size)]
+
+                for next_done in asyncio.as_completed(tasks):
+                    subheading = _clean_subheading(await next_done)
+                    if subheading is None:
+                        continue
+
+                    # Check if similar to any stored subheading
+                    is_similar, score, similar_to = await asyncio.to_thread(_is_similar_to_stored, subheading)
+
+                    if is_similar:
+                        print(f"❌ REJECTED - Too similar to: '{similar_to}'")
+                        print(f"   Similarity score: {score:.3f}")
+                        if similar_to not in avoid:
+                            avoid.append(similar_to)
+                        continue
+
+                    # Unique subheading found! Drop the rest of this round.
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.to_thread(_store_subheading, subheading)
+                    print(f"✅ SUCCESS - Unique subheading generated!")
+                    stored = await asyncio.to_thread(get_all_stored_subheadings)
+                    print(f"📊 Total stored subheadings: {len(stored)}")
+                    return subheading
+
             # Modify the prompt to avoid similar subheadings
-            api_prompt += f"\n\nAvoid topics similar to: {similar_to}"
-        else:
-            # Unique subheading found!
-            similarity_checker.add_subheading(subheading)
-            print(f"✅ SUCCESS - Unique subheading generated!")
-            print(f"📊 Total stored subheadings: {len(similarity_checker.get_stored_subheadings())}")
-            return subheading
+            for similar_to in avoid:
+                api_prompt += f"\n\nAvoid topics similar to: {similar_to}"
     
     # Max attempts reached
     print(f"\n❌ Failed to generate unique subheading after {max_attempts} attempts")
@@ -185,6 +364,8 @@ def get_all_stored_subheadings():
     Returns:
         list: List of all unique subheadings generated so far
     """
+    if SUBHEADING_STORE == "mongo":
+        return db.get_subheadings()
     return similarity_checker.get_stored_subheadings()
 
 
@@ -192,7 +373,10 @@ def clear_all_subheadings():
     """
     Clear all stored subheadings. Useful for starting fresh.
     """
-    similarity_checker.clear_stored_subheadings()
+    if SUBHEADING_STORE == "mongo":
+        db.clear_subheadings()
+    else:
+        similarity_checker.clear_stored_subheadings()
 
 
 # Example usage and testing
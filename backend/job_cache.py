@@ -0,0 +1,67 @@
+# backend/job_cache.py
+"""
+Redis cache of serialized job status for clients polling GET /api/jobs.
+
+Pending/running jobs are cached for half a second, finished jobs for an
+hour; db.mark_job_done / db.update_job_result drop the entry so the final
+result shows up immediately. Enabled by setting REDIS_URL. Redis errors are
+never fatal: the lookup just falls through to MongoDB.
+"""
+import os
+from typing import Dict, Optional
+
+import orjson
+import redis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+PENDING_TTL_MS = 500
+DONE_TTL_SECONDS = 3600
+
+redis_client = None
+if REDIS_URL:
+    redis_client = redis.Redis(
+        connection_pool=redis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=64, timeout=1)
+    )
+
+
+def _key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+
+def get_cached_job(job_id: str) -> Optional[bytes]:
+    """Return the cached JSON body for the job, or None on a miss."""
+    if redis_client is None:
+        return None
+    try:
+        return redis_client.get(_key(job_id))
+    except redis.RedisError as e:
+        print(f"Job cache read failed: {e}")
+        return None
+
+
+def cache_job(job_id: str, payload: Dict) -> bytes:
+    """Cache the serialized job and return the JSON body that was stored."""
+    body = orjson.dumps(payload, default=str)
+    if redis_client is None:
+        return body
+    try:
+        if payload.get("status") == "done":
+            redis_client.set(_key(job_id), body, ex=DONE_TTL_SECONDS)
+        else:
+            redis_client.set(_key(job_id), body, px=PENDING_TTL_MS)
+    except redis.RedisError as e:
+        print(f"Job cache write failed: {e}")
+    return body
+
+
+def invalidate_job(job_id: str):
+    if redis_client is None:
+        return
+    try:
+        redis_client.delete(_key(job_id))
+    except redis.RedisError as e:
+        print(f"Job cache invalidation failed: {e}")
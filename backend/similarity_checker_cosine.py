@@ -3,9 +3,57 @@ Semantic Sentence Similarity Checker with Storage
 Extended version that maintains a list of stored subheadings for comparison
 """
 
+import functools
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
+import torch
+
+try:
+    import faiss  # optional (faiss-cpu), used once the store gets large
+except ImportError:
+    faiss = None
+
+logger = logging.getLogger(__name__)
+
+# Above this many stored subheadings search moves from numpy to a faiss index
+FAISS_MIN_STORED = 10_000
+# Above this many the exact (flat) index is replaced by an HNSW graph, whose
+# search time grows logarithmically instead of linearly with the store
+FAISS_HNSW_MIN_STORED = 100_000
+HNSW_NEIGHBORS = 32
+HNSW_EF_SEARCH = 64
+
+# Weight precisions SemanticSimilarityChecker can load the model with
+PRECISIONS = ("fp32", "fp16", "int8")
+
+# Normalized embeddings kept per sentence, so a sentence that is checked and
+# then added (or checked again) goes through the model once
+ENCODE_CACHE_SIZE = 4096
+
+# End of input for stream_check: a private sentinel, so a None item from the
+# producer is not mistaken for the end of the stream
+_END = object()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_model(model_name, precision, device):
+    """
+    Load a model once per process; checkers with the same model, precision
+    and device share it instead of loading the weights again.
+    """
+    if precision == "fp16":
+        return SentenceTransformer(model_name, device=device, model_kwargs={"torch_dtype": torch.float16})
+    model = SentenceTransformer(model_name, device=device)
+    if precision == "int8":
+        # int8 weights for the Linear layers, activations quantized on the fly
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
 
 
 class SemanticSimilarityChecker:
@@ -14,19 +62,61 @@ class SemanticSimilarityChecker:
     Extended to store and compare against a list of previously seen subheadings.
     """
     
-    def __init__(self, model_name='all-MiniLM-L6-v2', threshold=0.75):
+    def __init__(self, model_name='all-MiniLM-L6-v2', threshold=0.75, quantize=False, precision="fp32",
+                 device="auto", store_path=None):
         """
         Initialize the similarity checker with a pre-trained model.
         
         Args:
             model_name (str): Name of the sentence transformer model to use.
             threshold (float): Similarity threshold (0-1). Values above this are considered similar.
+            quantize (bool): Keep the faiss index (large stores only) as 8-bit scalar-quantized
+                             vectors, a quarter of the float32 memory. Scores become approximate.
+            precision (str): Model weights, one of PRECISIONS. "fp16" halves the weights and
+                             is only faster on a GPU; "int8" dynamically quantizes the linear
+                             layers, which speeds up CPU encoding. Scores shift slightly
+                             in both cases.
+            device (str): torch device to encode on. "auto" picks CUDA, then Apple MPS, and
+                          falls back to the CPU. int8 models always run on the CPU.
+            store_path (str): .npz file the stored subheadings and their embeddings are kept in.
+                              Loaded here if it exists and rewritten whenever the store
+                              changes, so a restart neither forgets nor re-encodes them.
         """
-        self.model = SentenceTransformer(model_name)
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {PRECISIONS}, got {precision!r}")
+        if precision == "int8":
+            device = "cpu"
+        elif device == "auto":
+            device = self._detect_device()
+        self.device = device
+        self.model = _load_model(model_name, precision, device)
         self.threshold = threshold
+        self.quantize = quantize
+        if quantize and faiss is None:
+            logger.warning("quantize=True needs faiss (pip install faiss-cpu); storing float32 embeddings")
         self.stored_subheadings = []  # List to store unique subheadings
-        print(f"Loaded model: {model_name}")
-        print(f"Similarity threshold: {threshold}")
+        # L2-normalized float32 embeddings of stored_subheadings, one row each.
+        # Over-allocated and grown by doubling; only the first _num_stored rows are used.
+        self._stored_emb = None
+        self._num_stored = 0
+        self._index = None  # faiss index replacing _stored_emb for large stores
+        self._encode_cache = OrderedDict()  # sentence -> (D,) normalized float32 embedding
+        self._encode_lock = threading.Lock()
+        # encodes the next sentence of stream_check while the current one is scored
+        self._prefetch = ThreadPoolExecutor(max_workers=1)
+        self.store_path = store_path
+        logger.info("Loaded model: %s (%s on %s)", model_name, precision, device)
+        logger.info("Similarity threshold: %s", threshold)
+        if store_path is not None and os.path.exists(store_path):
+            self.load(store_path)
+    
+    @staticmethod
+    def _detect_device():
+        if torch.cuda.is_available():
+            return "cuda"
+        if torch.backends.mps.is_available():
+            return "mps"
+        return "cpu"
     
     def get_embeddings(self, sentences):
         """
@@ -36,11 +126,12 @@ class SemanticSimilarityChecker:
             sentences (list or str): Single sentence or list of sentences
             
         Returns:
-            numpy.ndarray: Embeddings for the input sentences
+            numpy.ndarray: L2-normalized embeddings for the input sentences, so the
+                           dot product of two rows is their cosine similarity
         """
         if isinstance(sentences, str):
             sentences = [sentences]
-        return self.model.encode(sentences)
+        return self.model.encode(sentences, convert_to_numpy=True, normalize_embeddings=True)
     
     def calculate_similarity(self, sentence1, sentence2):
         """
@@ -54,8 +145,8 @@ class SemanticSimilarityChecker:
             float: Similarity score between 0 and 1 (1 being most similar)
         """
         embeddings = self.get_embeddings([sentence1, sentence2])
-        similarity = cosine_similarity([embeddings[0]], [embeddings[1]])[0][0]
-        return float(similarity)
+        # unit vectors: the dot product is the cosine similarity
+        return float(np.dot(embeddings[0], embeddings[1]))
     
     def are_similar(self, sentence1, sentence2, return_score=False):
         """
@@ -77,6 +168,96 @@ class SemanticSimilarityChecker:
             return is_similar, similarity_score
         return is_similar
     
+    def _encode_normalized(self, sentences):
+        """
+        Encode sentences to a contiguous (n, D) float32 array of unit vectors.
+        Sentences found in the LRU cache are not sent to the model again; the
+        rest are encoded together in one call.
+        """
+        with self._encode_lock:
+            cached = {}
+            for sentence in sentences:
+                if sentence in self._encode_cache:
+                    self._encode_cache.move_to_end(sentence)
+                    cached[sentence] = self._encode_cache[sentence]
+        
+        missing = list(dict.fromkeys(s for s in sentences if s not in cached))
+        if missing:
+            encoded = self.model.encode(missing, batch_size=64, convert_to_numpy=True, normalize_embeddings=True)
+            encoded = np.asarray(encoded, dtype=np.float32)
+            with self._encode_lock:
+                for sentence, embedding in zip(missing, encoded):
+                    cached[sentence] = embedding
+                    self._encode_cache[sentence] = embedding
+                while len(self._encode_cache) > ENCODE_CACHE_SIZE:
+                    self._encode_cache.popitem(last=False)
+        
+        return np.ascontiguousarray(np.stack([cached[s] for s in sentences]), dtype=np.float32)
+    
+    def _append_embeddings(self, embeddings):
+        """Add (n, D) normalized embeddings to the store."""
+        if self._index is not None:
+            self._index.add(embeddings)
+            self._num_stored += len(embeddings)
+            if isinstance(self._index, faiss.IndexFlatIP) and self._num_stored > FAISS_HNSW_MIN_STORED:
+                self._index = self._build_hnsw_index(self._index.reconstruct_n(0, self._num_stored))
+            return
+        
+        needed = self._num_stored + len(embeddings)
+        if self._stored_emb is None or needed > len(self._stored_emb):
+            grown = np.empty((max(64, 2 * needed), embeddings.shape[1]), dtype=np.float32)
+            if self._num_stored:
+                grown[:self._num_stored] = self._stored_emb[:self._num_stored]
+            self._stored_emb = grown
+        self._stored_emb[self._num_stored:needed] = embeddings
+        self._num_stored = needed
+        
+        if faiss is not None and self._num_stored > FAISS_MIN_STORED:
+            self._index = self._build_index(self._stored_emb[:self._num_stored])
+            self._stored_emb = None
+    
+    def _build_index(self, embeddings):
+        """Build a faiss inner-product index holding the given normalized embeddings."""
+        dim = embeddings.shape[1]
+        if self.quantize:
+            index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+            # per-dimension ranges are learned once from everything stored so far
+            index.train(embeddings)
+        else:
+            index = faiss.IndexFlatIP(dim)
+        index.add(embeddings)
+        return index
+    
+    def _build_hnsw_index(self, embeddings):
+        """Build an approximate HNSW inner-product index holding the given normalized embeddings."""
+        index = faiss.IndexHNSWFlat(embeddings.shape[1], HNSW_NEIGHBORS, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        index.add(embeddings)
+        return index
+    
+    def _compare_to_stored(self, query):
+        """
+        Compare a (1, D) normalized embedding against the store.
+        
+        Returns:
+            tuple: (is_similar, max_similarity_score, most_similar_subheading)
+        """
+        if not self._num_stored:
+            return False, 0.0, None
+        
+        if self._index is not None:
+            scores, ids = self._index.search(query, 1)
+            best, max_similarity = int(ids[0, 0]), float(scores[0, 0])
+        else:
+            # cosine similarity against every stored row in one matrix-vector product
+            scores = self._stored_emb[:self._num_stored] @ query[0]
+            best = int(scores.argmax())
+            max_similarity = float(scores[best])
+        
+        if max_similarity <= 0.0:
+            return False, 0.0, None
+        return max_similarity >= self.threshold, max_similarity, self.stored_subheadings[best]
+    
     def is_similar_to_any_stored(self, new_subheading):
         """
         Check if a new subheading is similar to any stored subheading.
@@ -91,17 +272,32 @@ class SemanticSimilarityChecker:
         if not self.stored_subheadings:
             return False, 0.0, None
         
-        max_similarity = 0.0
-        most_similar = None
-        
-        for stored_subheading in self.stored_subheadings:
-            similarity = self.calculate_similarity(new_subheading, stored_subheading)
-            if similarity > max_similarity:
-                max_similarity = similarity
-                most_similar = stored_subheading
+        return self._compare_to_stored(self._encode_normalized([new_subheading]))
+    
+    def stream_check(self, sentences):
+        """
+        Check a stream of sentences against the stored subheadings. The next
+        sentence is encoded in a background thread while the current result
+        is scored and handed to the caller (torch releases the GIL while it
+        encodes). Subheadings the caller adds between items are taken into
+        account for the following items.
         
-        is_similar = max_similarity >= self.threshold
-        return is_similar, max_similarity, most_similar
+        Args:
+            sentences (iterable): Sentences to check, consumed lazily
+            
+        Yields:
+            tuple: (sentence, is_similar, max_similarity_score, most_similar_subheading)
+        """
+        iterator = iter(sentences)
+        sentence = next(iterator, _END)
+        pending = self._prefetch.submit(self._encode_normalized, [sentence]) if sentence is not _END else None
+        while sentence is not _END:
+            embedding = pending.result()
+            next_sentence = next(iterator, _END)
+            if next_sentence is not _END:
+                pending = self._prefetch.submit(self._encode_normalized, [next_sentence])
+            yield (sentence, *self._compare_to_stored(embedding))
+            sentence = next_sentence
     
     def add_subheading(self, subheading):
         """
@@ -113,14 +309,43 @@ class SemanticSimilarityChecker:
         Returns:
             bool: True if added successfully, False if it's similar to existing ones
         """
-        is_similar, score, similar_to = self.is_similar_to_any_stored(subheading)
+        added = self._add_encoded(subheading, self._encode_normalized([subheading]))
+        if added:
+            self._persist()
+        return added
+    
+    def batch_add(self, subheadings):
+        """
+        Add several subheadings, encoding all of them in one model call.
+        Each one is checked against the store, including the subheadings
+        accepted before it in the same list.
+        
+        Args:
+            subheadings (list): Subheadings to add, in order
+            
+        Returns:
+            list: True/False per subheading, as returned by add_subheading
+        """
+        if not subheadings:
+            return []
+        embeddings = self._encode_normalized(list(subheadings))
+        added = [self._add_encoded(subheading, embeddings[i:i + 1])
+                 for i, subheading in enumerate(subheadings)]
+        if any(added):
+            self._persist()
+        return added
+    
+    def _add_encoded(self, subheading, embedding):
+        """add_subheading for a subheading whose (1, D) normalized embedding is known."""
+        is_similar, score, similar_to = self._compare_to_stored(embedding)
         
         if is_similar:
-            print(f"⚠️  Subheading not added (too similar to: '{similar_to}' with score {score:.3f})")
+            logger.debug("Subheading not added (too similar to: %r with score %.3f)", similar_to, score)
             return False
         
         self.stored_subheadings.append(subheading)
-        print(f"✅ Added subheading: '{subheading}' (Total: {len(self.stored_subheadings)})")
+        self._append_embeddings(embedding)
+        logger.debug("Added subheading: %r (Total: %d)", subheading, len(self.stored_subheadings))
         return True
     
     def get_stored_subheadings(self):
@@ -137,7 +362,52 @@ class SemanticSimilarityChecker:
         Clear all stored subheadings.
         """
         self.stored_subheadings = []
-        print("🗑️  Cleared all stored subheadings")
+        self._stored_emb = None
+        self._num_stored = 0
+        self._index = None
+        self._persist()
+        logger.debug("Cleared all stored subheadings")
+    
+    def save(self, path):
+        """
+        Write the stored subheadings and their embeddings to an .npz file.
+        
+        Args:
+            path (str): File to write; replaced atomically
+        """
+        if self._index is not None:
+            embeddings = self._index.reconstruct_n(0, self._num_stored)
+        elif self._num_stored:
+            embeddings = self._stored_emb[:self._num_stored]
+        else:
+            embeddings = np.empty((0, 0), dtype=np.float32)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, subheadings=np.array(self.stored_subheadings, dtype=str), embeddings=embeddings)
+        os.replace(tmp_path, path)
+    
+    def load(self, path):
+        """
+        Replace the stored subheadings with the ones written by save().
+        
+        Args:
+            path (str): File written by save()
+        """
+        with np.load(path) as data:
+            subheadings = data["subheadings"].tolist()
+            embeddings = np.ascontiguousarray(data["embeddings"], dtype=np.float32)
+        self.stored_subheadings = []
+        self._stored_emb = None
+        self._num_stored = 0
+        self._index = None
+        if subheadings:
+            self.stored_subheadings = subheadings
+            self._append_embeddings(embeddings)
+        logger.info("Loaded %d stored subheadings from %s", len(subheadings), path)
+    
+    def _persist(self):
+        if self.store_path is not None:
+            self.save(self.store_path)
     
     def batch_compare(self, sentence, sentence_list):
         """
@@ -150,15 +420,17 @@ class SemanticSimilarityChecker:
         Returns:
             list: List of tuples (similarity_score, is_similar) for each comparison
         """
-        results = []
-        for s in sentence_list:
-            similarity = self.calculate_similarity(sentence, s)
-            results.append((similarity, similarity >= self.threshold))
-        return results
+        if not sentence_list:
+            return []
+        # one encode call for the reference and all candidates, then one matrix-vector product
+        embeddings = self._encode_normalized([sentence] + list(sentence_list))
+        scores = embeddings[1:] @ embeddings[0]
+        return [(float(score), bool(score >= self.threshold)) for score in scores]
 
 
 # Example usage
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s")
     checker = SemanticSimilarityChecker(threshold=0.75)
     
     print("\n" + "="*70)
@@ -0,0 +1,57 @@
+# backend/tasks.py
+"""
+Celery task queue for video jobs.
+
+The web process only inserts the job document and enqueues its id; workers
+started with
+
+    celery -A backend.tasks.celery_app worker -Q video --concurrency=N
+
+pick jobs up from the broker and run the same pipeline as workflow.py.
+"""
+import os
+
+from celery import Celery
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BROKER_URL = os.getenv("BROKER_URL")
+
+celery_app = Celery("story", broker=BROKER_URL or "redis://localhost")
+celery_app.conf.update(
+    task_acks_late=True,
+    worker_prefetch_multiplier=1,
+    task_routes={"story.process_job": {"queue": "video"}},
+)
+
+
+@celery_app.task(name="story.process_job")
+def process_job(job_id: str, job_type: str = "NORMAL"):
+    """
+    Claim the job and run the video pipeline for it.
+    Does nothing if another worker already claimed the job.
+    """
+    # imported lazily so the web process never loads the rendering stack
+    from backend.db import claim_job
+    from workflow import run_job, run_agent_job
+
+    job_doc = claim_job(job_id, job_type)
+    if job_doc is None:
+        print(f"Job {job_id} already claimed, skipping")
+        return False
+
+    if job_type == "NORMAL":
+        return run_job(job_doc)
+    return run_agent_job(job_doc)
+
+
+def enqueue_job(job_id: str, job_type: str = "NORMAL") -> bool:
+    """
+    Hand the job to the broker. Without BROKER_URL the job stays pending in
+    MongoDB and is picked up by workflow.py's polling loop instead.
+    """
+    if not BROKER_URL:
+        return False
+    process_job.delay(job_id, job_type)
+    return True
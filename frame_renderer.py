@@ -0,0 +1,320 @@
+import textwrap
+
+import matplotlib
+# headless rasterizer; must be selected before pyplot is imported
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+import numpy as np
+
+# figures are only ever rasterized to arrays, never shown or redrawn on change
+plt.ioff()
+
+plt.rcParams.update({
+    "path.simplify": True,
+    "path.simplify_threshold": 1.0,
+    "agg.path.chunksize": 10000,
+    # bundled with matplotlib: no font fallback search when text is laid out
+    "font.family": "DejaVu Sans",
+})
+
+# This module only draws: no API clients and no global frame state, so
+# frames can be rendered in worker processes. Layout (node positions and
+# ghost nodes) is decided by the caller, see main.generate_frames.
+# Each process keeps one figure and clears it between story frames, since
+# building a figure costs more than drawing a frame on it.
+
+# Shape marker mapping
+_SHAPE_MAP = {
+    'circle': 'o',
+    'square': 's',
+    'triangle': '^',
+    'diamond': 'D',
+    'pentagon': 'p',
+    'hexagon': 'h',
+    'star': '*',
+    'box': 's'
+}
+
+
+def _marker(shape):
+    """matplotlib marker for a shape name from the script, circle if unknown."""
+    return _SHAPE_MAP.get(shape.lower(), 'o')
+
+
+# Output resolution: 12.8x7.2 inches at 100 dpi -> 1280x720 (720p). Sizes are
+# in points, so a lower dpi shrinks the image without changing the layout.
+FIGSIZE = (12.8, 7.2)
+DPI = 100
+
+# Frame text is wrapped at this many characters; 16:9 frames have room for
+# longer lines, which keeps the text block short
+TEXT_WRAP_WIDTH = 70
+TEXT_FONTSIZE = 24
+# Height of one line of frame text as a fraction of the figure height
+TEXT_LINE_HEIGHT = TEXT_FONTSIZE * 1.2 / 72 / FIGSIZE[1]
+
+_FIG = None
+_AX = None
+
+
+def _snapshot(fig):
+    """Rasterize the figure and return it as an (H, W, 3) uint8 RGB array."""
+    # Don't use tight_layout as we manually set subplots_adjust
+    fig.canvas.draw()
+    # copy: the canvas buffer is reused by the next draw
+    return np.asarray(fig.canvas.buffer_rgba())[:, :, :3].copy()
+
+
+def _get_figure():
+    """Return this process's figure and axes, emptied of the previous frame."""
+    global _FIG, _AX
+    if _FIG is None:
+        _FIG, _AX = plt.subplots(figsize=FIGSIZE, dpi=DPI, facecolor='white')
+    _AX.clear()
+    for text in list(_FIG.texts):
+        text.remove()
+    return _FIG, _AX
+
+
+def render_text_frame(frame_text):
+    """
+    Render a frame that only shows text.
+
+    :param frame_text: text to display at the center, may be None
+    :return: (H, W, 3) uint8 RGB image
+    """
+    fig, ax = _get_figure()
+    ax.axis('off')
+
+    if frame_text:
+        # Add text at center with word wrapping for better readability
+        wrapped_text = textwrap.fill(frame_text, width=TEXT_WRAP_WIDTH)
+        fig.text(0.5, 0.5, wrapped_text,
+                 ha='center', va='center',
+                 fontsize=TEXT_FONTSIZE,
+                 color='black')
+
+    return _snapshot(fig)
+
+
+def _visible_graph(nodes, connections, visible_nodes):
+    """
+    :return: (set of node indices to draw, list of (source, target) edges).
+             Nodes at either end of an edge are drawn even if not in visible_nodes.
+    """
+    # If visible_nodes not specified, show all nodes
+    if visible_nodes is None:
+        visible_nodes = range(len(nodes))
+    shown = {i for i in visible_nodes if i < len(nodes)}
+
+    # Expand connections into edges, keeping the first occurrence of each
+    edges = {}
+    for source_nodes, target_node in connections:
+        if not isinstance(source_nodes, (list, tuple)):
+            source_nodes = (source_nodes,)
+        for source_node in source_nodes:
+            edges[(source_node, target_node)] = None
+            shown.update((source_node, target_node))
+    return shown, list(edges)
+
+
+def _new_graph_figure(frame_text):
+    # Reuse the figure for drawing, with proper margins
+    fig, ax = _get_figure()
+
+    # Add frame text at the top if provided with padding
+    if frame_text:
+        # Add text with the same word wrapping as text-only frames
+        wrapped_text = textwrap.fill(frame_text, width=TEXT_WRAP_WIDTH)
+        fig.text(0.5, 0.92, wrapped_text,
+                 ha='center', va='top',
+                 fontsize=TEXT_FONTSIZE,
+                 color='black')
+        # Start the graph below the last line of text
+        text_bottom = 0.92 - (wrapped_text.count('\n') + 1) * TEXT_LINE_HEIGHT
+        fig.subplots_adjust(top=min(0.8, text_bottom - 0.08), bottom=0.05, left=0.05, right=0.95)
+    else:
+        # More space for graph when no text
+        fig.subplots_adjust(top=0.95, bottom=0.05, left=0.05, right=0.95)
+
+    ax.axis('off')
+    # Set explicit limits to ensure margins
+    ax.set_xlim(-0.05, 1.05)
+    ax.set_ylim(-0.05, 1.05)
+    return fig, ax
+
+
+def _label_lengths(texts):
+    return np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+
+
+def _scatter_by_marker(ax, pos, indices, markers, sizes, colors, **kwargs):
+    """
+    Draw nodes with one scatter call per marker.
+
+    :param indices: node indices to draw, all present in pos
+    :param markers, sizes, colors: marker / size / color of each node in indices
+    :return: dict of marker -> PathCollection
+    """
+    by_marker = {}
+    for k, marker in enumerate(markers):
+        by_marker.setdefault(marker, []).append(k)
+
+    xy = np.array([pos[i] for i in indices], dtype=np.float64).reshape(-1, 2)
+    collections = {}
+    for marker, group in by_marker.items():
+        collections[marker] = ax.scatter(
+            xy[group, 0],
+            xy[group, 1],
+            s=sizes[group],
+            c=[colors[k] for k in group],
+            marker=marker,
+            zorder=2,  # above edges, like networkx draws nodes
+            **kwargs
+        )
+    return collections
+
+
+def _draw_ghosts(ax, pos, ghosts):
+    """
+    Draw disappeared nodes faded.
+
+    :param ghosts: dict of node index -> (shape, color, text)
+    :return: dict of node index -> (node, collection, label); ghosts with the
+             same marker share one collection
+    """
+    indices = list(ghosts)
+    markers = [_marker(ghosts[i][0]) for i in indices]
+    sizes = 2500 + _label_lengths([ghosts[i][2] for i in indices]) * 220  # Same formula as active nodes
+
+    # Draw ghost nodes (semi-transparent, gray)
+    collections = _scatter_by_marker(ax, pos, indices, markers, sizes, ['lightgray'] * len(indices), alpha=0.3)
+
+    artists = {}
+    for i, marker in zip(indices, markers):
+        node = ghosts[i]
+        # Draw ghost label with strikethrough effect
+        label = ax.text(pos[i][0], pos[i][1], f'({node[2]})',
+                        fontsize=8,
+                        ha='center',
+                        va='center',
+                        color='gray',
+                        alpha=0.5,
+                        style='italic')
+        artists[i] = (node, collections[marker], label)
+    return artists
+
+
+def _draw_nodes(ax, pos, indices, nodes):
+    """Draw the given nodes with one scatter call per shape, and their labels."""
+    texts = [nodes[i][2] for i in indices]
+    lengths = _label_lengths(texts)
+
+    # Dynamic node size based on label length (minimum 3000, maximum 8000)
+    sizes = np.clip(2500 + lengths * 220, 3000, 8000)
+    _scatter_by_marker(ax, pos, indices, [_marker(nodes[i][0]) for i in indices], sizes,
+                       [nodes[i][1] for i in indices])
+
+    # Shorter labels = larger font, longer labels = smaller font
+    font_sizes = np.clip(120 // np.maximum(lengths, 1), 8, 12)
+    for i, label_text, font_size in zip(indices, texts, font_sizes.tolist()):
+        ax.text(pos[i][0], pos[i][1], label_text,
+                fontsize=font_size,
+                ha='center',
+                va='center',
+                color='white',
+                fontweight='bold',
+                bbox=dict(boxstyle='round,pad=0.3', facecolor='black', alpha=0.3, edgecolor='none'))
+
+
+def _draw_edges(ax, pos, edges):
+    """Draw the given edges as one LineCollection, with an arrow head at each midpoint."""
+    ax.add_collection(LineCollection(
+        [(pos[u], pos[v]) for u, v in edges],
+        colors='black',
+        linewidths=3,
+        zorder=1,  # below nodes, like networkx draws edges
+    ))
+
+    for u, v in edges:
+        # Draw arrow head at the midpoint of the edge
+        x1, y1 = pos[u]
+        x2, y2 = pos[v]
+        mx, my = (x1 + x2) / 2, (y1 + y2) / 2
+        dx, dy = x2 - x1, y2 - y1
+        ax.arrow(mx, my, dx * 0.001, dy * 0.001, head_width=0.02, head_length=0.02, fc='black', ec='black')
+
+
+def render_sequence(steps):
+    """
+    Render the animation steps of one story frame on a single figure.
+
+    Within a story frame every step only adds nodes and edges (and drops the
+    ghosts of nodes that became visible), so each step draws just those
+    artists on top of the previous step instead of redrawing the graph.
+
+    :param steps: list of render_frame argument tuples
+                  (nodes, connections, frame_text, visible_nodes, pos, ghost_nodes)
+                  sharing the same nodes and frame_text
+    :return: list of (H, W, 3) uint8 RGB images, one per step
+    """
+    nodes, _, frame_text, _, _, _ = steps[0]
+
+    # Handle case with no nodes - display only text
+    if not nodes:
+        image = render_text_frame(frame_text)
+        return [image] * len(steps)
+
+    fig, ax = _new_graph_figure(frame_text)
+    ghost_artists = {}
+    drawn_nodes = set()
+    drawn_edges = set()
+    images = []
+
+    for nodes, connections, frame_text, visible_nodes, pos, ghost_nodes in steps:
+        shown, edges = _visible_graph(nodes, connections, visible_nodes)
+
+        # Ghosts of nodes that are visible now go away; a ghost whose
+        # label changed (previous story frame -> this one) is redrawn
+        ghosts = dict(ghost_nodes)
+        for i in [i for i in ghost_artists if ghosts.get(i) != ghost_artists[i][0]]:
+            _, collection, label = ghost_artists.pop(i)
+            label.remove()
+            if collection.axes is not None:
+                collection.remove()
+        # ghosts that shared a removed collection are drawn again below
+        for i in [i for i in ghost_artists if ghost_artists[i][1].axes is None]:
+            ghost_artists.pop(i)[2].remove()
+        ghost_artists.update(_draw_ghosts(ax, pos, {i: node for i, node in ghosts.items()
+                                                    if i not in ghost_artists}))
+
+        # edges naming a node that does not exist are skipped
+        new_edges = [(u, v) for u, v in edges if (u, v) not in drawn_edges and u in pos and v in pos]
+        if new_edges:
+            _draw_edges(ax, pos, new_edges)
+            drawn_edges.update(new_edges)
+
+        new_nodes = [i for i in range(len(nodes)) if i in shown and i not in drawn_nodes]
+        _draw_nodes(ax, pos, new_nodes, nodes)
+        drawn_nodes.update(new_nodes)
+
+        images.append(_snapshot(fig))
+
+    return images
+
+
+def render_frame(nodes, connections, frame_text, visible_nodes, pos, ghost_nodes):
+    """
+    Render one graph frame to an image.
+
+    :param nodes: List of tuples of the form [(shape, color, text), ..]
+    :param connections: List of tuples of the form [((0, 2, 4), 3), ..]
+    :param frame_text: Optional text to display at the top of the frame
+    :param visible_nodes: Set of node indices that should be visible. If None, all nodes are visible.
+    :param pos: dict of node index -> (x, y) for every node that can be drawn
+    :param ghost_nodes: list of (index, (shape, color, text)) for nodes of the previous
+                        frame that disappeared, drawn faded
+    :return: (H, W, 3) uint8 RGB image
+    """
+    return render_sequence([(nodes, connections, frame_text, visible_nodes, pos, ghost_nodes)])[0]
@@ -1,18 +1,25 @@
+import logging
 import os
+import re
 
 from openai import OpenAI
 from dotenv import load_dotenv
 
+from llm_cache import LLMCache
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 client = OpenAI(
   base_url="https://openrouter.ai/api/v1",
   api_key=os.getenv("OPEN_ROUTER_API_KEY"),
 )
 
-def get_raw_output(prompt):
-    # First API call with reasoning
-    prompt_real = f"you will generate script for a educational video animations. " \
+llm_cache = LLMCache()
+
+def _build_script_prompt(prompt):
+    return f"you will generate script for a educational video animations. " \
                    f"The video is supposed to properly explain and teach the topic: '{prompt}' for the video " \
                            "encoding, we have multiple options: so mostly you create videos with multiple " \
                            "frames each frame can either have graph containing some boxes and some connections for explaining" \
@@ -31,49 +38,126 @@ def get_raw_output(prompt):
                            "8 frames to explain the concept clearly. Make sure 20% of the frames don't have a graph, as in they have NO_NODE in place of node details. For example" \
                            "a full output might look something like:" \
                            "frame1?frametext1?NO_NODE?NO_NODE$frame2?frametext2?shape1:color1:label1,shape2:color2:label2,shape3:color3:label3?0,1:2;2:1"
-    response = client.chat.completions.create(
-        # model="openai/gpt-5.1",
-        model="openai/gpt-oss-20b:free",
-        messages=[
+
+
+def _script_request(prompt):
+    """Arguments of the script completion; also the cache key."""
+    return {
+        # "model": "openai/gpt-5.1",
+        "model": "openai/gpt-oss-20b:free",
+        "messages": [
             {
                 "role": "user",
-                "content": prompt_real
+                "content": _build_script_prompt(prompt)
             }
         ],
-        extra_body={"reasoning": {"enabled": True}}
-    )
+        "extra_body": {"reasoning": {"enabled": True}},
+    }
+
+
+def get_raw_output(prompt):
+    # First API call with reasoning
+    request = _script_request(prompt)
 
-    # Extract the assistant message with reasoning_details
-    response = response.choices[0].message
+    def complete():
+        response = client.chat.completions.create(**request)
+        # Extract the assistant message with reasoning_details
+        return response.choices[0].message.content
 
-    return response.content
+    return llm_cache.get_or_set(request, complete)
 
-def parse_output(raw_output):
-    frames = []
-    for frame_text in raw_output.split("$"):
-        text = None
-        nodes = []
-        connections = []
-
-        frame_segments = frame_text.split("?")
-        text = frame_segments[1]
-        node_text_raw = frame_segments[2]
-        connection_text_raw = frame_segments[3]
-
-        if node_text_raw != "NO_NODE":
+
+def _split_frames(text_chunks):
+    """Yield '$'-delimited frames from a sequence of text chunks as each one completes."""
+    buffer = ""
+    for delta in text_chunks:
+        buffer += delta
+        *complete, buffer = buffer.split("$")
+        for raw_frame in complete:
+            if raw_frame.strip():
+                yield raw_frame
+
+    if buffer.strip():
+        yield buffer
+
+
+def stream_raw_frames(prompt):
+    """
+    Stream the script completion and yield each raw frame as soon as its
+    '$' delimiter arrives, so callers can start on frame 1 while the model
+    is still writing the rest. The last frame is yielded when the stream ends.
+    Completed scripts are cached, and a cached script is replayed without
+    calling the model.
+
+    :param prompt: topic of the video
+    :return: generator of raw frame strings (frame_number?frame_text?nodes?connections)
+    """
+    request = _script_request(prompt)
+    cached = llm_cache.get(request)
+    if cached is not None:
+        print("script cache hit")
+        yield from _split_frames([cached])
+        return
+
+    stream = client.chat.completions.create(**request, stream=True)
+    received = []
+
+    def deltas():
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                received.append(delta)
+                yield delta
+
+    yield from _split_frames(deltas())
+
+    # only reached when the whole completion was consumed
+    llm_cache.set(request, "".join(received))
+
+
+# frame_number?frame_text?nodes?connections; anything after a fourth '?' is ignored
+FRAME_PATTERN = re.compile(r"([^?]*)\?([^?]*)\?([^?]*)\?([^?]*)")
+
+
+def parse_frame(frame_text):
+    """
+    Parse one raw frame.
+
+    :param frame_text: frame_number?frame_text?nodes?connections
+    :return: {text, nodes, connections}, or None if the frame is malformed
+    """
+    match = FRAME_PATTERN.match(frame_text.strip())
+    if match is None:
+        print("skipping malformed frame", frame_text)
+        return None
+    _, text, node_text_raw, connection_text_raw = match.groups()
+
+    nodes = []
+    connections = []
+    if node_text_raw.strip() != "NO_NODE":
+        try:
             for node_text in node_text_raw.split(","):
-                node_tuple = node_text.split(":")
-                nodes.append(node_tuple)
+                shape, color, label = node_text.split(":")
+                nodes.append([shape.strip(), color.strip(), label.strip()])
 
             for con_text in connection_text_raw.split(";"):
-                conn_text_parsed = con_text.split(":")
-                start_nodes = tuple([int(el) for el in conn_text_parsed[0].split(',')])
-                end_node = int(conn_text_parsed[1])
-                connections.append((start_nodes, end_node))
+                if not con_text.strip():
+                    continue
+                start_text, end_text = con_text.split(":")
+                start_nodes = tuple(int(el) for el in start_text.split(","))
+                connections.append((start_nodes, int(end_text)))
+        except ValueError:
+            print("skipping malformed frame", frame_text)
+            return None
 
-        frames.append({"text": text, "nodes": nodes, "connections": connections})
+    return {"text": text, "nodes": nodes, "connections": connections}
 
-    return frames
+
+def parse_output(raw_output):
+    frames = (parse_frame(frame_text) for frame_text in raw_output.split("$") if frame_text.strip())
+    return [frame for frame in frames if frame is not None]
 
 
 def generate_script(job):
@@ -96,11 +180,27 @@ def generate_script(job):
     # file_type = job['file_type']
 
     raw_output = get_raw_output(prompt)
-    print("raw_output", raw_output)
+    logger.debug("raw_output %s", raw_output)
     parsed_output = parse_output(raw_output)
 
     return parsed_output
 
 
-# output = generate_script({"prompt": "Explain how the dijkstras algorithm works in detail."})
-# print(output)
\ No newline at end of file
+def stream_script(job):
+    """
+    Same as generate_script, but yields each parsed frame while the
+    completion is still streaming.
+
+    :param job: same structure as generate_script
+    :return: generator of {text, nodes, connections} frame dicts
+    """
+    for raw_frame in stream_raw_frames(job['prompt']):
+        logger.debug("raw frame %s", raw_frame)
+        frame = parse_frame(raw_frame)
+        if frame is not None:
+            yield frame
+
+
+if __name__ == "__main__":
+    output = generate_script({"prompt": "Explain how the dijkstras algorithm works in detail."})
+    print(output)
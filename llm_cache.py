@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CACHE_DIR = os.getenv("STORY_TELLER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "story_teller"))
+
+# Script completions are reused for a day
+LLM_CACHE_TTL_SECONDS = 24 * 3600
+
+
+class LLMCache:
+    """
+    On-disk cache of LLM completions in a sqlite file.
+
+    Entries are keyed on the SHA256 of the request (model, messages,
+    temperature, ...), so only byte-identical requests share a response.
+    """
+
+    def __init__(self, path=None, ttl_seconds=LLM_CACHE_TTL_SECONDS):
+        """
+        :param path: sqlite file, defaults to CACHE_DIR/llm.sqlite
+        :param ttl_seconds: how long a stored response stays valid
+        """
+        if path is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            path = os.path.join(CACHE_DIR, "llm.sqlite")
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, created_at REAL, value BLOB)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def key(request):
+        """
+        :param request: dict of the completion request arguments
+        :return: hex SHA256 of the request
+        """
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, request):
+        """
+        :return: the cached response, or None if missing or expired
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created_at, value FROM completions WHERE key = ?", (self.key(request),)
+            ).fetchone()
+        if row is None or time.time() - row[0] > self.ttl_seconds:
+            return None
+        return pickle.loads(row[1])
+
+    def set(self, request, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, created_at, value) VALUES (?, ?, ?)",
+                (self.key(request), time.time(), pickle.dumps(value)),
+            )
+            self._conn.commit()
+
+    def get_or_set(self, request, compute):
+        """
+        Return the cached response for request, or call compute() and cache
+        its result. None results are not cached.
+        """
+        value = self.get(request)
+        if value is None:
+            value = compute()
+            if value is not None:
+                self.set(request, value)
+        return value
@@ -1,67 +1,183 @@
-import time
+import base64
+import functools
+import hashlib
+import json
+import logging
+import math
 from collections import defaultdict
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
 
-from generate_script import generate_script
+from generate_script import stream_script
 import networkx as nx
-import matplotlib.pyplot as plt
-from moviepy import ImageClip, concatenate_videoclips
+from moviepy import ImageClip, ImageSequenceClip, concatenate_videoclips
 import os
-import tempfile
-import textwrap
+import uuid
 
 from dotenv import load_dotenv
 from elevenlabs.client import ElevenLabs
 from elevenlabs.play import play
 from moviepy import AudioFileClip
-from backend  import db
 from moviepy import CompositeAudioClip
 
+from frame_renderer import render_frame, render_sequence
+from llm_cache import CACHE_DIR
 
-FETCH_INTERVAL_SECONDS = 60
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 elevenlabs = ElevenLabs(
   api_key=os.getenv("ELEVEN_LABS_KEY"),
 )
 
-# Global state to preserve layout and previous frame information
-_last_frame_state = {
-    'positions': None,
-    'nodes': None,
-    'graph': None,
-    'next_position_index': 0  # Track position for new nodes
-}
+# Concurrent ElevenLabs requests while the script is streaming in
+TTS_WORKERS = 8
+
+TTS_VOICE_ID = "JBFqnCBsd6RMkjVDRZzb"
+# turbo model: several times faster than eleven_multilingual_v2, still multilingual
+TTS_MODEL_ID = "eleven_turbo_v2_5"
+# ElevenLabs streaming latency optimization, 0 (off) to 4; 4 also turns off the
+# text normalizer (numbers, dates, ...), 3 is the fastest level that keeps it
+TTS_STREAMING_LATENCY = 3
+# Narration mp3s, keyed on the text, voice and model
+TTS_CACHE_DIR = os.path.join(CACHE_DIR, "tts")
+os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+# Finished videos, one file per job
+VIDEO_OUTPUT_DIR = os.getenv("VIDEO_OUTPUT_DIR", ".")
+os.makedirs(VIDEO_OUTPUT_DIR, exist_ok=True)
+# Narrate the whole video in one request (see get_stitched_audio) instead of per frame
+STITCH_NARRATION = os.getenv("STITCH_NARRATION", "0") == "1"
+
+# How new nodes are placed: "spring" (force-directed, existing nodes stay put)
+# or "predefined" (concentric circles by node index)
+NODE_LAYOUT = os.getenv("NODE_LAYOUT", "spring")
+
+# Closest two node centers may be, in [0, 1] coordinates (nodes are ~0.07 wide)
+MIN_NODE_DISTANCE = 0.12
+# Predefined positions tried when the layout puts a node in a bad spot
+PREDEFINED_SLOTS = 64
+
+# Processes drawing frames; 1 renders in the calling process. Kept small:
+# each worker is a separate interpreter with matplotlib loaded.
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", min(4, os.cpu_count() or 1)))
+_render_pool = None
+
+
+@dataclass(frozen=True)
+class FrameState:
+    """
+    Layout carried from one frame to the next: node positions and the nodes
+    of the previous frame (for ghost nodes). Each video threads its own state
+    through the frames, so videos built at the same time cannot interfere.
+    """
+    positions: Optional[dict] = None
+    nodes: Optional[tuple] = None
+
+
+@functools.lru_cache(maxsize=1)
+def _background_music_clip():
+    # opened once per process; every video takes a subclip of it, which
+    # shares the ffmpeg reader instead of probing and decoding the file again
+    return AudioFileClip("background_reduced_vol.mp3")
 
 
 def generate_background_music(prompt):
 #      lets use a pregenreated one for now
-    audio_background_clip = AudioFileClip("background_reduced_vol.mp3")
-    return audio_background_clip
+    return _background_music_clip()
 
 
 def get_audio(text):
-    audio_stream = elevenlabs.text_to_speech.convert(
+    """
+    Narrate text with ElevenLabs and return it as an AudioFileClip.
+
+    Finished mp3s are kept in TTS_CACHE_DIR under the SHA256 of
+    (text, voice, model), so a text that was narrated before is not sent again.
+    """
+    key = hashlib.sha256(f"{text}\0{TTS_VOICE_ID}\0{TTS_MODEL_ID}".encode("utf-8")).hexdigest()
+    cached_path = os.path.join(TTS_CACHE_DIR, f"{key}.mp3")
+    if os.path.exists(cached_path):
+        return AudioFileClip(cached_path)
+
+    # streaming endpoint: chunks arrive (and are written) while the rest is still being synthesized
+    audio_stream = elevenlabs.text_to_speech.stream(
         text=text,
-        voice_id="JBFqnCBsd6RMkjVDRZzb",
-        model_id="eleven_multilingual_v2",
+        voice_id=TTS_VOICE_ID,
+        model_id=TTS_MODEL_ID,
         output_format="mp3_44100_128",
+        optimize_streaming_latency=TTS_STREAMING_LATENCY,
     )
 
-    temp_dir = tempfile.gettempdir()
-    audio_path = f"tts_{int(time.time() * 1000)}.mp3"
+    # unique per call, several clips are synthesized at the same time
+    audio_path = os.path.join(TTS_CACHE_DIR, f".tts_{uuid.uuid4().hex}.mp3")
 
     # IMPORTANT: iterate through the stream, do NOT do f.write(audio_stream)
-    with open(audio_path, "wb") as f:
-        for chunk in audio_stream:
-            f.write(chunk)
+    try:
+        with open(audio_path, "wb") as f:
+            for chunk in audio_stream:
+                f.write(chunk)
+    except BaseException:
+        os.remove(audio_path)
+        raise
+    # only complete files ever appear under the cache name
+    os.replace(audio_path, cached_path)
 
     # Now load as MoviePy AudioFileClip
-    audio_clip = AudioFileClip(audio_path)
+    audio_clip = AudioFileClip(cached_path)
 
     return audio_clip
 
+def get_stitched_audio(texts):
+    """
+    Narrate several frame texts with a single ElevenLabs request and split
+    the result back into one clip per text, using the character timestamps
+    returned with the audio. One request instead of one per frame saves the
+    per-request overhead and keeps the voice consistent across frames.
+
+    :param texts: frame texts in playback order
+    :return: list of AudioFileClip, one per text
+    """
+    # a blank line between frames makes the voice pause there
+    separator = "\n\n"
+    full_text = separator.join(texts)
+    key = hashlib.sha256(f"{full_text}\0{TTS_VOICE_ID}\0{TTS_MODEL_ID}\0stitched".encode("utf-8")).hexdigest()
+    audio_path = os.path.join(TTS_CACHE_DIR, f"{key}.mp3")
+    bounds_path = os.path.join(TTS_CACHE_DIR, f"{key}.json")
+
+    if not (os.path.exists(audio_path) and os.path.exists(bounds_path)):
+        response = elevenlabs.text_to_speech.convert_with_timestamps(
+            text=full_text,
+            voice_id=TTS_VOICE_ID,
+            model_id=TTS_MODEL_ID,
+            output_format="mp3_44100_128",
+        )
+        start_times = response.alignment.character_start_times_seconds
+
+        # each frame's audio runs from its first character to the next frame's first character
+        starts = []
+        offset = 0
+        for text in texts:
+            starts.append(start_times[offset] if offset < len(start_times) else start_times[-1])
+            offset += len(text) + len(separator)
+        bounds = [[start, end] for start, end in zip(starts, starts[1:] + [None])]
+
+        temp_path = os.path.join(TTS_CACHE_DIR, f".tts_{uuid.uuid4().hex}.mp3")
+        with open(temp_path, "wb") as f:
+            f.write(base64.b64decode(response.audio_base_64))
+        with open(bounds_path, "w") as f:
+            json.dump(bounds, f)
+        os.replace(temp_path, audio_path)
+
+    with open(bounds_path) as f:
+        bounds = json.load(f)
+    return [AudioFileClip(audio_path).subclipped(start, end) for start, end in bounds]
+
+
 # Predefined positions for nodes (circular layout around center)
+@functools.lru_cache(maxsize=1024)
 def _get_predefined_position(index):
     """
     Get a predefined position for a node based on its index.
@@ -78,8 +194,6 @@ def _get_predefined_position(index):
     :param index: Node index (0 is center, 1+ are in layers)
     :return: (x, y) position tuple with values in [0, 1]
     """
-    import math
-    
     if index == 0:
         # First node at center
         return (0.5, 0.5)
@@ -87,16 +201,12 @@ def _get_predefined_position(index):
     # Determine which layer this node belongs to
     # Layer 1 has nodes 1-6 (6 nodes)
     # Layer 2 has nodes 7-18 (12 nodes)
-    # Layer k has nodes with 6*k positions
-    layer = 1
-    nodes_before_layer = 1  # Node 0 is at center
-    nodes_in_current_layer = 6
-    
-    # Find which layer the node is in
-    while nodes_before_layer + nodes_in_current_layer <= index:
-        nodes_before_layer += nodes_in_current_layer
-        layer += 1
-        nodes_in_current_layer = 6 * layer
+    # Layer k has nodes with 6*k positions, so 1 + 3*k*(k-1) nodes come before it;
+    # the layer is the largest k with 3*k*(k-1) <= index - 1, i.e. with
+    # (6k - 3)^2 <= 12*(index - 1) + 9 (exact integer math, no float rounding)
+    layer = (math.isqrt(12 * (index - 1) + 9) + 3) // 6
+    nodes_before_layer = 1 + 3 * layer * (layer - 1)  # Node 0 is at center
+    nodes_in_current_layer = 6 * layer
     
     # Position within the current layer (0-indexed)
     position_in_layer = index - nodes_before_layer
@@ -121,28 +231,114 @@ def _get_predefined_position(index):
     return (x, y)
 
 
-def get_jobs():
-    jobs = db.get_all_new_jobs()
-    return jobs
+def _layout_new_nodes(pos, nodes, connections):
+    """
+    Place the nodes that have no position yet with a force-directed
+    (Fruchterman-Reingold) layout of the frame's graph. Nodes placed in
+    earlier frames stay fixed, so the picture does not jump between frames.
 
+    :param pos: dict of node index -> (x, y), updated in place
+    :param nodes: nodes of the frame
+    :param connections: connections used for the layout
+    """
+    new_nodes = [i for i in range(len(nodes)) if i not in pos]
+    if not new_nodes:
+        return
+
+    if NODE_LAYOUT == "predefined":
+        for i in new_nodes:
+            pos[i] = _get_predefined_position(i)
+        return
+
+    G = nx.Graph()
+    G.add_nodes_from(range(len(nodes)))
+    for source_nodes, target_node in connections:
+        if not isinstance(source_nodes, (list, tuple)):
+            source_nodes = (source_nodes,)
+        for source_node in source_nodes:
+            if source_node in G and target_node in G:
+                G.add_edge(source_node, target_node)
 
-def reset_frame_state():
+    fixed = [i for i in G if i in pos]
+    # the concentric predefined positions are the starting point for new nodes
+    initial = {i: pos[i] if i in pos else _get_predefined_position(i) for i in G}
+    if fixed:
+        # with fixed nodes the result stays in the same [0, 1] coordinates
+        layout = nx.spring_layout(G, pos=initial, fixed=fixed, seed=42, k=0.3)
+    else:
+        layout = nx.spring_layout(G, pos=initial, seed=42, center=(0.5, 0.5), scale=0.45)
+
+    for i in new_nodes:
+        x, y = layout[i]
+        candidate = (float(x), float(y))
+        # nodes pushed off the canvas or onto another node go to the first
+        # free predefined slot instead
+        if not _is_free_position(candidate, pos):
+            free_slots = (p for p in map(_get_predefined_position, range(PREDEFINED_SLOTS))
+                          if _is_free_position(p, pos))
+            # crowded canvas: keep the layout's choice, clamped into bounds
+            clamped = (max(0.05, min(0.95, candidate[0])), max(0.05, min(0.95, candidate[1])))
+            candidate = next(free_slots, clamped)
+        pos[i] = candidate
+
+
+def _is_free_position(position, pos):
+    x, y = position
+    if not (0.05 <= x <= 0.95 and 0.05 <= y <= 0.95):
+        return False
+    return all(math.dist(position, other) >= MIN_NODE_DISTANCE for other in pos.values())
+
+
+def _prepare_frame(state, nodes, connections, preserve_last=False, frame_text=None, visible_nodes=None,
+                   layout_connections=None):
     """
-    Reset the global frame state. Call this when starting a new video sequence.
+    Lay out one frame and return the arguments for frame_renderer.render_frame.
+
+    Positions depend on the previous frames, so this runs in order in the main
+    process; the drawing itself can then happen in any process. Text-only
+    frames leave the state untouched.
+
+    :param state: FrameState after the previous frame
+    :param layout_connections: connections that decide where new nodes go,
+                               defaults to connections
+    :return: (render_frame arguments, FrameState after this frame)
     """
-    global _last_frame_state
-    # IMPORTANT: Clear the existing dict instead of reassigning!
-    # This ensures all imports continue to reference the same object
-    _last_frame_state.clear()
-    _last_frame_state.update({
-        'positions': None,
-        'nodes': None,
-        'graph': None,
-        'next_position_index': 0
-    })
-
-
-def generate_frame(nodes, connections, duration, preserve_last=False, frame_text=None, visible_nodes=None):
+    if not nodes:
+        return (nodes, connections, frame_text, visible_nodes, None, []), state
+
+    # Determine node positioning with fixed positions
+    pos = {}
+    
+    # ALWAYS use previous positions as base if available
+    if state.positions is not None:
+        pos = state.positions
+
+    # Assign positions to new nodes; existing ones keep theirs. Only copy when
+    # something is added: earlier steps keep referencing the dict they were
+    # laid out with, and after a story frame's first step nothing is new.
+    if any(i not in pos for i in range(len(nodes))):
+        pos = dict(pos)
+        _layout_new_nodes(pos, nodes, connections if layout_connections is None else layout_connections)
+
+    # Disappeared nodes (ghost nodes) if preserve_last is True
+    ghost_nodes = []
+    if preserve_last and state.nodes is not None:
+        if visible_nodes is None:
+            current_node_indices = set(range(len(nodes)))
+        else:
+            current_node_indices = {i for i in range(len(nodes)) if i in visible_nodes}
+        previous_node_indices = set(range(len(state.nodes)))
+        disappeared_nodes = previous_node_indices - current_node_indices
+        ghost_nodes = [(i, state.nodes[i]) for i in disappeared_nodes if i in pos]
+
+    # ALWAYS carry positions to the next frame (whether preserve_last is True or not)
+    # This ensures positions are available for subsequent frames
+    render_args = (nodes, connections, frame_text, visible_nodes, pos, ghost_nodes)
+    return render_args, FrameState(positions=pos, nodes=tuple(nodes))
+
+
+def generate_frame(nodes, connections, duration, preserve_last=False, frame_text=None, visible_nodes=None,
+                   state=FrameState()):
     """
     Generate a video frame showing a directed graph with specified nodes and connections.
     
@@ -157,238 +353,66 @@ def generate_frame(nodes, connections, duration, preserve_last=False, frame_text
                          disappeared nodes as ghost nodes (faded/transparent)
     :param frame_text: Optional text to display at the top of the frame
     :param visible_nodes: Set of node indices that should be visible. If None, all nodes are visible.
-    :return: moviepy.ImageClip object
+    :param state: FrameState returned for the previous frame; the default starts a new video
+    :return: (moviepy.ImageClip object, FrameState to pass to the next frame)
     """
-    global _last_frame_state
-    
-    # Handle case with no nodes - display only text
-    if not nodes or len(nodes) == 0:
-        fig, ax = plt.subplots(figsize=(14, 10))
-        ax.axis('off')
-        
-        if frame_text:
-            # Add text at center with word wrapping at 60 characters for better readability
-            wrapped_text = textwrap.fill(frame_text, width=60)
-            fig.text(0.5, 0.5, wrapped_text, 
-                    ha='center', va='center', 
-                    fontsize=24, 
-                    color='black')
-        
-        # Save the figure to a temporary file
-        temp_dir = tempfile.gettempdir()
-        temp_image_path = os.path.join(temp_dir, f'text_frame_{int(time.time() * 1000)}.png')
-        plt.savefig(temp_image_path, dpi=150, facecolor='white', bbox_inches=None)
-        plt.close(fig)
-        
-        # Create video clip from the image
-        clip = ImageClip(temp_image_path, duration=duration)
-        return clip
-    
-    # print("trying to generate one frame")
-    # Create a directed graph for current nodes
-    G = nx.DiGraph()
-    
-    # If visible_nodes not specified, show all nodes
-    if visible_nodes is None:
-        visible_nodes = set(range(len(nodes)))
-    
-    # Add nodes with their labels
-    current_node_indices = set()
-    # print("getting nodes in generate frame", nodes, connections, "visible:", visible_nodes)
-    for i, (shape, color, text) in enumerate(nodes):
-        if i in visible_nodes:  # Only add visible nodes
-            G.add_node(i, shape=shape, color=color, text=text)
-            current_node_indices.add(i)
-    
-    # Add edges based on connections
-    for source_nodes, target_node in connections:
-        if isinstance(source_nodes, (list, tuple)):
-            for source_node in source_nodes:
-                G.add_edge(source_node, target_node)
-        else:
-            G.add_edge(source_nodes, target_node)
-    
-    # Create figure for drawing with proper margins
-    fig, ax = plt.subplots(figsize=(14, 10))
-    
-    # Add frame text at the top if provided with padding
-    if frame_text:
-        # Add text with word wrapping at 60 characters for consistency with text-only frames
-        wrapped_text = textwrap.fill(frame_text, width=60)
-        fig.text(0.5, 0.88, wrapped_text, 
-                ha='center', va='top', 
-                fontsize=24, 
-                color='black')
-        # Adjust subplot to leave more space for larger text
-        fig.subplots_adjust(top=0.8, bottom=0.05, left=0.05, right=0.95)
-    else:
-        # More space for graph when no text
-        fig.subplots_adjust(top=0.95, bottom=0.05, left=0.05, right=0.95)
-    
-    ax.axis('off')
-    # Set explicit limits to ensure margins
-    ax.set_xlim(-0.05, 1.05)
-    ax.set_ylim(-0.05, 1.05)
-    
-    # Determine node positioning with fixed positions
-    pos = {}
-    
-    # ALWAYS use previous positions as base if available
-    if _last_frame_state['positions'] is not None:
-        pos = _last_frame_state['positions'].copy()
-    
-    # Assign positions to all nodes (new and existing)
-    for i in range(len(nodes)):
-        if i not in pos:
-            # Assign predefined position for new nodes
-            pos[i] = _get_predefined_position(i)
-    
-    # Also preserve positions for ghost nodes (if preserve_last is enabled)
-    if preserve_last and _last_frame_state['positions'] is not None:
-        for idx in _last_frame_state['positions']:
-            if idx not in pos:
-                pos[idx] = _last_frame_state['positions'][idx]
-    
-    # Shape marker mapping
-    shape_map = {
-        'circle': 'o',
-        'square': 's',
-        'triangle': '^',
-        'diamond': 'D',
-        'pentagon': 'p',
-        'hexagon': 'h',
-        'star': '*',
-        'box': 's'
-    }
-    
-    # Calculate dynamic node sizes based on label length
-    # Base size of 3000, plus 200 per character (minimum 3000, maximum 8000)
-    node_sizes = {}
-    for i, (shape, color, text) in enumerate(nodes):
-        text_length = len(text)
-        # Formula: base size + (characters * character_width)
-        node_size = max(3000, min(8000, 2500 + text_length * 220))
-        node_sizes[i] = node_size
-    
-    # Draw disappeared nodes (ghost nodes) if preserve_last is True
-    if preserve_last and _last_frame_state['nodes'] is not None:
-        previous_node_indices = set(range(len(_last_frame_state['nodes'])))
-        disappeared_nodes = previous_node_indices - current_node_indices
-        
-        for i in disappeared_nodes:
-            if i < len(_last_frame_state['nodes']) and i in pos:
-                shape, color, text = _last_frame_state['nodes'][i]
-                marker = shape_map.get(shape.lower(), 'o')
-                ghost_size = 2500 + len(text) * 220  # Same formula as active nodes
-                
-                # Draw ghost node (semi-transparent, gray)
-                nx.draw_networkx_nodes(
-                    G, pos,
-                    nodelist=[i],
-                    node_color='lightgray',
-                    node_shape=marker,
-                    node_size=ghost_size,
-                    alpha=0.3,
-                    ax=ax
-                )
-                
-                # Draw ghost label with strikethrough effect
-                if i in pos:
-                    ax.text(pos[i][0], pos[i][1], f'({text})',
-                           fontsize=8,
-                           ha='center',
-                           va='center',
-                           color='gray',
-                           alpha=0.5,
-                           style='italic')
-    
-    # Draw current nodes by shape and color with dynamic sizing
-    for i, (shape, color, text) in enumerate(nodes):
-        if i in G.nodes():
-            marker = shape_map.get(shape.lower(), 'o')
-            nx.draw_networkx_nodes(
-                G, pos,
-                nodelist=[i],
-                node_color=color,
-                node_shape=marker,
-                node_size=node_sizes[i],
-                ax=ax
-            )
-    
-    # Draw edges
-    nx.draw_networkx_edges(
-        G, pos,
-        edge_color='black',
-        arrows=False,
-        width=3,
-        ax=ax
-    )
-    
-    # Draw arrow heads at the midpoint of each edge
-    for u, v in G.edges():
-        x1, y1 = pos[u]
-        x2, y2 = pos[v]
-        mx, my = (x1 + x2) / 2, (y1 + y2) / 2
-        dx, dy = x2 - x1, y2 - y1
-        # Draw arrow head at midpoint
-        ax.arrow(mx, my, dx * 0.001, dy * 0.001, head_width=0.02, head_length=0.02, fc='black', ec='black')
-    
-    # Draw labels for current nodes with better sizing
-    labels = {i: node_data[2] for i, node_data in enumerate(nodes) if i in G.nodes()}
-    
-    # Draw labels with dynamic font size based on text length
-    for i, label_text in labels.items():
-        if i in pos:
-            # Shorter labels = larger font, longer labels = smaller font
-            font_size = max(8, min(12, 120 // max(1, len(label_text))))
-            ax.text(pos[i][0], pos[i][1], label_text,
-                   fontsize=font_size,
-                   ha='center',
-                   va='center',
-                   color='white',
-                   fontweight='bold',
-                   bbox=dict(boxstyle='round,pad=0.3', facecolor='black', alpha=0.3, edgecolor='none'))
-    
-    # Save the figure to a temporary file with proper margins
-    temp_dir = tempfile.gettempdir()
-    temp_image_path = os.path.join(temp_dir, f'graph_frame_{id(G)}.png')
-    # Don't use tight_layout as we manually set subplots_adjust
-    plt.savefig(temp_image_path, dpi=150, facecolor='white', bbox_inches=None)
-    plt.close(fig)
-    
-    # Create video clip from the image
-    clip = ImageClip(temp_image_path, duration=duration)
-    
-    # ALWAYS update positions for next frame (whether preserve_last is True or not)
-    # This ensures positions are available for subsequent frames
-    _last_frame_state['positions'] = pos
-    _last_frame_state['nodes'] = nodes
-    _last_frame_state['graph'] = G
-    
-    # Clean up temporary file (optional, uncomment if you want immediate cleanup)
-    # os.remove(temp_image_path)
-    
-    return clip
+    render_args, state = _prepare_frame(state, nodes, connections, preserve_last, frame_text, visible_nodes)
+    return ImageClip(render_frame(*render_args), duration=duration), state
+
 
-def generate_frames(frames, preserve_continuity=True):
+def _get_render_pool():
+    """
+    Process pool shared by all videos rendered in this process, or None to
+    render inline: with RENDER_WORKERS <= 1, or inside a daemonic process
+    (e.g. a Celery prefork child) that is not allowed to start children.
+    """
+    global _render_pool
+    if RENDER_WORKERS <= 1 or multiprocessing.current_process().daemon:
+        return None
+    if _render_pool is None:
+        # spawn: matplotlib is not fork-safe on every platform
+        _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS,
+                                           mp_context=multiprocessing.get_context("spawn"))
+    return _render_pool
+
+
+def _submit_sequence(render_pool, steps):
+    """Draw the animation steps of one story frame; returns a Future of their images."""
+    if render_pool is not None:
+        return render_pool.submit(render_sequence, steps)
+    return _completed(render_sequence(steps))
+
+
+def _completed(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def generate_frames(frames, preserve_continuity=True, audio_clips=None):
     """
     Generate multiple frames and concatenate them into a single video.
     
-    :param frames: List of frame specifications, each containing:
+    :param frames: Iterable of frame specifications, each containing:
                    - (nodes, connections, duration) for basic frames
                    - (nodes, connections, duration, frame_text) for frames with text
     :param preserve_continuity: If True, maintains position continuity and shows ghost nodes between frames
+    :param audio_clips: Optional dict of story frame index -> Future of its narration clip.
+                        Frames without an entry are narrated with get_audio.
     :return: moviepy.CompositeVideoClip or concatenated clip
     """
-    # Reset state before generating new sequence
-    if preserve_continuity:
-        reset_frame_state()
-    
+    # every video starts from an empty layout
+    state = FrameState()
+
     clips = []
 
-    print("lenght fo frames", len(frames))
     # print("in get  generate frames", frames)
-    clip_groups = defaultdict(list)
+    clip_groups = {}
+    durations = defaultdict(list)
+    render_pool = _get_render_pool()
+    # animation steps of the story frame currently being collected
+    steps = []
+    steps_key = None
 
     for i, frame_data in enumerate(frames):
 
@@ -403,22 +427,58 @@ def generate_frames(frames, preserve_continuity=True):
         visible_nodes = frame_data.get('visible_nodes', None)
         # print("i", i, nodes, connections, duration, "visible:", visible_nodes)
 
+        # A story frame is complete once the next one starts: its steps are
+        # drawn together, on the render pool while the next frames are laid out
+        if steps and (ind, text) != steps_key:
+            clip_groups[steps_key] = _submit_sequence(render_pool, steps)
+            steps = []
+        steps_key = (ind, text)
+
         # First frame doesn't preserve (nothing to preserve from)
         # Subsequent frames preserve if preserve_continuity is enabled
         preserve_flag = preserve_continuity and i > 0
-        clip = generate_frame(nodes, connections, duration, preserve_last=preserve_flag, 
-                             frame_text=text, visible_nodes=visible_nodes)
-        clip_groups[(ind, text)].append(clip)
+        render_args, state = _prepare_frame(state, nodes, connections, preserve_last=preserve_flag,
+                                            frame_text=text, visible_nodes=visible_nodes,
+                                            layout_connections=frame_data.get('layout_connections'))
+        steps.append(render_args)
+        durations[steps_key].append(duration)
+
+    if steps:
+        clip_groups[steps_key] = _submit_sequence(render_pool, steps)
+
+    # one clip per story frame, holding each animation step for its duration
+    for clips_group_key, images in clip_groups.items():
+        clip_groups[clips_group_key] = ImageSequenceClip(images.result(), durations=durations[clips_group_key])
+
+    # Request narration for all story frames at once instead of one by one;
+    # frames whose audio was already requested by the caller reuse that
+    text_to_audio_clip = {}
+    if STITCH_NARRATION and audio_clips is None:
+        try:
+            stitched = get_stitched_audio([text for _, text in clip_groups])
+            text_to_audio_clip = {key: _completed(clip) for key, clip in zip(clip_groups, stitched)}
+        except Exception as e:
+            print("Stitched narration failed, narrating frame by frame:", e)
+
+    tts_pool = ThreadPoolExecutor(max_workers=TTS_WORKERS)
+    for clips_group_key in clip_groups:
+        id, text = clips_group_key
+        if clips_group_key in text_to_audio_clip:
+            continue
+        if audio_clips is not None and id in audio_clips:
+            text_to_audio_clip[clips_group_key] = audio_clips[id]
+        else:
+            text_to_audio_clip[clips_group_key] = tts_pool.submit(get_audio, text)
+    tts_pool.shutdown(wait=False)
 
     clips = []
-    print("lenght fo frames", len(clip_groups))
+    logger.debug("story frames: %d", len(clip_groups))
     for clips_group_key in clip_groups:
-        clips_group = clip_groups[clips_group_key]
+        frame_clip = clip_groups[clips_group_key]
         id = clips_group_key[0]
         text = clips_group_key[1]
-        frame_clip = concatenate_videoclips(clips_group, method="compose")
 
-        audio_clip = get_audio(text)
+        audio_clip = text_to_audio_clip[clips_group_key].result()
         # how to set frame clip lenght to max frame_clip_length and audio_clip length
 
         video_duration = frame_clip.duration
@@ -437,7 +497,7 @@ def generate_frames(frames, preserve_continuity=True):
 
         clips.append(frame_clip)
 
-    print("lenght fo frames", len(clips))
+    logger.debug("clips: %d", len(clips))
 
     # Concatenate all clips
     final_clip = concatenate_videoclips(clips, method="compose")
@@ -515,55 +575,64 @@ def generate_animated_frame_sequence(nodes, connections, frame_text=None, durati
     return frame_sequence
 
 
-def generate_video_from_story(story_frames, duration_per_step=1.0, preserve_continuity=True):
+def generate_video_from_story(story_frames, duration_per_step=1.0, preserve_continuity=True, audio_clips=None):
     """
     Generate a video from a story sequence where each frame animates sequentially.
     
-    :param story_frames: List of story frame dicts with format:
+    :param story_frames: Iterable of story frame dicts with format:
                         [{'text': '...', 'nodes': [[...]], 'connections': [...]}, ...]
+                        A generator is consumed lazily, so rendering starts with the first frame.
     :param duration_per_step: Duration in seconds for each animation step
     :param preserve_continuity: If True, maintains position continuity between story frames
+    :param audio_clips: Optional dict of story frame index -> Future of its narration clip
     :return: moviepy video clip
     """
-    all_frames = []
-    ind = 0
-    for story_frame in story_frames:
+    def formatted_frames():
+        # Convert each story frame to the dict format expected by generate_frames
+        for ind, story_frame in enumerate(story_frames):
+            nodes = [tuple(node) for node in story_frame['nodes']]  # Convert to tuples
+            connections = story_frame['connections']
+            text = story_frame.get('text', None)
+
+            # Generate animated sequence for this story frame
+            animated_sequence = generate_animated_frame_sequence(
+                nodes, connections, text, duration_per_step
+            )
+            for step_nodes, step_connections, duration, frame_text, visible_nodes in animated_sequence:
+                yield {
+                    'ind': ind,
+                    'text': frame_text,
+                    'nodes': step_nodes,
+                    'connections': step_connections,
+                    # all connections of the story frame, used to place its nodes
+                    'layout_connections': connections,
+                    'duration': duration,
+                    'visible_nodes': visible_nodes
+                }
 
-        nodes = [tuple(node) for node in story_frame['nodes']]  # Convert to tuples
-        connections = story_frame['connections']
-        text = story_frame.get('text', None)
-        
-        # Generate animated sequence for this story frame
-        animated_sequence = generate_animated_frame_sequence(
-            nodes, connections, text, duration_per_step
-        )
-        for el in animated_sequence:
-            all_frames.append((ind, el))
-        # all_frames.extend(animated_sequence)
-        ind += 1
-    
-    # Convert all_frames to the dict format expected by generate_frames
-    formatted_frames = []
-    for frame in all_frames:
-        ind = frame[0]
-        nodes, connections, duration, frame_text, visible_nodes = frame[1]
-        formatted_frames.append({
-            'ind': ind,
-            'text': frame_text,
-            'nodes': nodes,
-            'connections': connections,
-            'duration': duration,
-            'visible_nodes': visible_nodes
-        })
-    
     # Generate the complete video with formatted frames
-    return generate_frames(formatted_frames, preserve_continuity=preserve_continuity)
+    return generate_frames(formatted_frames(), preserve_continuity=preserve_continuity, audio_clips=audio_clips)
 
 
 def generate_clip(job):
-    frames = generate_script(job)
-    print("all frames", len(frames), frames)
-    generated_clip = generate_video_from_story(frames)
+    """
+    Stream the script and build the video while it arrives: narration for each
+    story frame is requested from ElevenLabs as soon as the frame is parsed,
+    and its graph frames are rendered while the model writes the next one.
+    """
+    with ThreadPoolExecutor(max_workers=TTS_WORKERS) as tts_pool:
+        audio_clips = {}
+
+        def frames_with_audio():
+            for ind, frame in enumerate(stream_script(job)):
+                logger.debug("got frame %d %r", ind, frame)
+                if not STITCH_NARRATION:
+                    audio_clips[ind] = tts_pool.submit(get_audio, frame['text'])
+                yield frame
+
+        # stitched narration needs every text, so it is requested after the script is complete
+        generated_clip = generate_video_from_story(frames_with_audio(),
+                                                   audio_clips=None if STITCH_NARRATION else audio_clips)
     print("cliup is generated")
 
     return generated_clip
@@ -595,8 +664,12 @@ def engage_workers(job):
 
 
 
-    file_path = "testvideo.mp4"
-    generated_clip.write_videofile(file_path, fps=20, audio_codec='aac')
+    # a file per job, so jobs running side by side (threads or Celery
+    # children sharing the working directory) never write the same video
+    file_path = os.path.join(VIDEO_OUTPUT_DIR, f"video-{uuid.uuid4().hex}.mp4")
+    # frames are mostly still images held for a while
+    generated_clip.write_videofile(file_path, fps=20, audio_codec='aac', preset='veryfast',
+                                   threads=os.cpu_count(), ffmpeg_params=['-tune', 'stillimage'])
     print("file saved")
     abs_file_path = os.path.abspath(file_path)
 
@@ -615,17 +688,7 @@ def main(prompt, file_path):
     return "dummy descrption", file_path, "dumm subheading"
 
 
-# def main():
-#     while True:
-#         jobs = get_jobs()
-#         print("jobs", jobs)
-#         prompt = jobs['prompt_text']
-#         filepath = jobs['file_path']
-#
-#         for job in jobs:
-#             engage_workers(job)
-#
-#         time.sleep(FETCH_INTERVAL_SECONDS)
-
-# engage_workers({})
-# main()
\ No newline at end of file
+# spawned render workers import this file as __mp_main__; only the
+# process started from the command line makes a video
+if __name__ == "__main__":
+    main("Explain how the dijkstras algorithm works in detail.", None)
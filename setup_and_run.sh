@@ -27,7 +27,8 @@ echo "Environment variables loaded."
 
 # backend
 echo "[5/6] Starting Flask backend on http://localhost:8000 ..."
-python backend/app.py &
+python -m backend.db
+python -m backend.app &
 BACKEND_PID=$!
 
 sleep 2
@@ -1,4 +1,6 @@
 import os
+import random
+import time
 import google.auth
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -10,6 +12,13 @@ from googleapiclient.errors import HttpError
 # Scopes required for uploading videos
 SCOPES = ['https://www.googleapis.com/auth/youtube.upload']
 
+# Upload in 8MB pieces (a multiple of 256KB as the API requires): a failed
+# request only resends its chunk, and progress is reported per chunk
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Statuses retried with exponential backoff, as in Google's upload guide
+RETRIABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 10
+
 
 YOUTUBE_INSTANCE = None
 
@@ -21,16 +30,6 @@ def authenticate():
     script_dir = os.path.dirname(os.path.abspath(__file__))
     token_path = os.path.join(script_dir, 'token.json')
     secrets_path = os.path.join(script_dir, 'client_secrets.json')
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                secrets_path, SCOPES)
-            # Use a fixed port instead of port=0
-            creds = flow.run_local_server(port=8080)
-    
-    
     
     # Token file stores the user's access and refresh tokens
     if os.path.exists(token_path):
@@ -43,7 +42,8 @@ def authenticate():
         else:
             flow = InstalledAppFlow.from_client_secrets_file(
                 secrets_path, SCOPES)  # Use absolute path
-            creds = flow.run_local_server(port=0)
+            # Use a fixed port instead of port=0
+            creds = flow.run_local_server(port=8080)
         
         # Save credentials for next run
         with open(token_path, 'w') as token:
@@ -91,8 +91,9 @@ def upload_video(youtube, video_file, title, description, category_id='22',
     # Create MediaFileUpload object
     media = MediaFileUpload(
         video_file,
-        chunksize=-1,  # Upload in a single request
-        resumable=True
+        chunksize=UPLOAD_CHUNK_SIZE,
+        resumable=True,
+        mimetype='video/*'
     )
     
     try:
@@ -104,8 +105,23 @@ def upload_video(youtube, video_file, title, description, category_id='22',
         )
         
         response = None
+        retry = 0
         while response is None:
-            status, response = request.next_chunk()
+            try:
+                status, response = request.next_chunk()
+            except (HttpError, OSError) as e:
+                # OSError: dropped connections and socket timeouts
+                if isinstance(e, HttpError) and e.resp.status not in RETRIABLE_STATUS_CODES:
+                    raise
+                if retry >= MAX_RETRIES:
+                    raise
+                # the next call resumes from the last chunk the server acknowledged
+                retry += 1
+                sleep_seconds = random.random() * 2 ** retry
+                print(f"Upload error ({e}), retrying in {sleep_seconds:.1f}s")
+                time.sleep(sleep_seconds)
+                continue
+            retry = 0
             if status:
                 print(f"Uploaded {int(status.progress() * 100)}%")
         
@@ -1,17 +1,27 @@
 # backend/worker.py
 
+import os
+import threading
 import time
 from typing import Tuple, List, Dict
 
-from backend.db import get_next_pending_job, update_job_result, serialize_job
-from main import main
+from pymongo.errors import OperationFailure
 
-from backend.generate_subheading import generate_prompt_subheading
-from video_uploader import upload_video, YOUTUBE_INSTANCE
+# The pipeline is imported inside the functions that use it: main.py's spawned
+# render workers import this file as __mp_main__ and only draw frames, so they
+# must not create the MongoDB client, the embedding model and the API clients.
 
 # from backend.app import YOUTUBE_INSTANCE
 YOUTUBE_INSTANCE = None
 
+# Without render workers main() draws on this process's one figure: videos
+# are built one at a time, while the rest of both job kinds (including
+# uploads) runs concurrently
+_video_lock = threading.Lock()
+
+# Server error code for "$changeStream is only supported on replica sets"
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
 def generate_video_from_job(prompt_text: str, file_path: str | None) -> Tuple[str, str, List[Dict]]:
     """
     This is a placeholder; replace with actual integration
@@ -39,11 +49,23 @@ def process_one_job():
     - Generate video + metadata.
     - Update job document with results.
     """
+    from backend.db import get_next_pending_job
+
     job_doc = get_next_pending_job()
     if not job_doc:
         print("No pending jobs found.")
         return False
 
+    return run_job(job_doc)
+
+
+def run_job(job_doc: dict) -> bool:
+    """
+    Generate the video for an already claimed job and store the result.
+    """
+    from backend.db import update_job_result, serialize_job
+    from main import main
+
     job_id = str(job_doc["_id"])
     prompt_text = job_doc.get("prompt_text")
     file_path = job_doc.get("file_path")  # may be None if no file uploaded
@@ -54,7 +76,8 @@ def process_one_job():
 
     # TODO Call video generation logic here
     # description, video_url, subheadings = generate_video_from_job(prompt_text, file_path)
-    description, video_url, subheadings = main(prompt_text, file_path)
+    with _video_lock:
+        description, video_url, subheadings = main(prompt_text, file_path)
 
     # Update the document in Mongo
     updated_doc = update_job_result(job_id, description, video_url, subheadings)
@@ -65,46 +88,121 @@ def process_one_job():
 
 
 def process_one_agent_job():
+    from backend.db import get_next_pending_job
+
     job = get_next_pending_job("AGENT")
     print("agent job", job)
 
     if job is not None:
-        base_prompt_text = job.get("prompt_text")
-        print("base prmopt", base_prompt_text)
-        prompt_text = generate_prompt_subheading(base_prompt_text)
-        print("got new prompt text", prompt_text)
+        run_agent_job(job)
+
+
+def run_agent_job(job: dict):
+    """
+    Generate a video from a subheading of the agent job's prompt and upload it.
+    Afterwards the job is pending again for its next run, or marked error if
+    the run raised.
+    """
+    from backend.db import mark_agent_job_failed, reschedule_agent_job
+
+    job_id = str(job["_id"])
+    try:
+        video_url = make_agent_video(job)
+    except Exception as e:
+        mark_agent_job_failed(job_id, str(e))
+        raise
+    reschedule_agent_job(job_id, video_url)
+
+
+def make_agent_video(job: dict) -> str:
+    """
+    :return: URL of the uploaded video, or the local path of the video if it
+             was not uploaded
+    """
+    from backend.generate_subheading import generate_prompt_subheading
+    from main import main
+    from video_uploader import upload_video
+
+    base_prompt_text = job.get("prompt_text")
+    print("base prmopt", base_prompt_text)
+    prompt_text = generate_prompt_subheading(base_prompt_text)
+    print("got new prompt text", prompt_text)
+    video_id = None
+    with _video_lock:
         description, video_url, subheadings = main(prompt_text, None)
 
-        video_file = video_url  # Change to your video file path
-        title = prompt_text
-        description = 'This video was uploaded using the YouTube API'
-        tags = ['python', 'youtube api', 'automation']
+    video_file = video_url
+    title = prompt_text
+    description = 'This video was uploaded using the YouTube API'
+    tags = ['python', 'youtube api', 'automation']
+
+    ## upload sequence
+    print("upalod to youtube", video_file)
+    if YOUTUBE_INSTANCE is not None:
+        video_id = upload_video(youtube=YOUTUBE_INSTANCE,
+                                video_file=video_file,
+                                title=title,
+                                description=description,
+                                tags=tags,
+                                privacy_status='public')
 
-        ## upload sequence
-        print("upalod to youtube", video_url)
-        if YOUTUBE_INSTANCE is not None:
-            video_id = upload_video(youtube=YOUTUBE_INSTANCE,
-                                    video_file=video_file,
-                                    title=title,
-                                    description=description,
-                                    tags=tags,
-                                    privacy_status='public')
+    if not video_id:
+        # keep the video so it can be uploaded by hand
+        print("Video not uploaded, kept at", video_file)
+        return video_file
 
-        print("Upload successfull", video_id)
+    os.remove(video_file)
+    print("Upload successfull", video_id)
+    return f"https://www.youtube.com/watch?v={video_id}"
 
 
 
 def run_worker_loop(poll_interval: int = 5):
+    """
+    Process new jobs as soon as they are inserted:
+      - Watch the jobs collection and run each new job right away
+      - Check for agent jobs in a background thread every poll_interval
+        seconds, so the two kinds of job do not wait for each other
+    Falls back to polling every poll_interval seconds when the server does
+    not support change streams (standalone MongoDB).
+    """
+    from backend.db import ensure_indexes, stream_pending_jobs
+
+    ensure_indexes()
+    print("Worker started. Watching for new jobs...")
+    threading.Thread(target=agent_job_loop, args=(poll_interval,), daemon=True).start()
+    try:
+        for job_doc in stream_pending_jobs():
+            run_job(job_doc)
+    except OperationFailure as e:
+        if e.code != CHANGE_STREAMS_UNSUPPORTED:
+            raise
+        print("Change streams unavailable, polling for new jobs...")
+    poll_for_jobs(poll_interval)
+
+
+def agent_job_loop(poll_interval: int = 5):
+    """
+    Run one agent job every poll_interval seconds. A failed job is reported
+    and does not stop the loop.
+    """
+    while True:
+        try:
+            process_one_agent_job()
+        except Exception as e:
+            print(f"Agent job failed: {e}")
+        time.sleep(poll_interval)
+
+
+def poll_for_jobs(poll_interval: int = 5):
     """
     Every poll_interval seconds:
       - Fetch a job
       - If found, process it immediately
       - If none, just sleep and try again
     """
-    print("Worker started. Polling for new jobs...")
     while True:
         success = process_one_job()
-        process_one_agent_job()
         if not success:
             # No job; sleep and poll again
             time.sleep(poll_interval)